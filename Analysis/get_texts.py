@@ -1,48 +1,138 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import pymongo
+# Document frequencies of stemmed words in flats' comments.
+# Comments are read with a batched cursor in _id order, tokenized and
+# stemmed in worker processes and merged batch by batch. The checkpoint
+# keeps the counters and the last merged _id, so an interrupted run
+# continues with --resume. Output: "<word>\t<count>" sorted by count.
+import argparse
+import json
+import os
+import string
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
 import nltk
 import nltk.corpus
-import ipdb
-import string
-from collections import defaultdict
+import pymongo
+from bson import ObjectId
+
+stop_words = None
+stemmer = None
+# Per-worker cache: comments repeat the same few thousand words
+stem_cache = {}
+
+
+def init_worker():
+    global stop_words, stemmer
+    stop_words = set(nltk.corpus.stopwords.words('russian'))
+    stop_words.update(['что', 'это', 'так', 'вот', 'быть', 'как', 'в', '—', 'к', 'на'])
+    stemmer = nltk.stem.snowball.RussianStemmer()
+    stemmer.stopwords = stop_words
+
 
-db = pymongo.MongoClient()['telegram_realty_bot_db']
-db = db['flats']
+def stem(word):
+    result = stem_cache.get(word)
+    if result is None:
+        result = stem_cache[word] = stemmer.stem(word)
+    return result
 
-stop_words = nltk.corpus.stopwords.words('russian')
-stop_words.extend(['что', 'это', 'так', 'вот', 'быть', 'как', 'в', '—', 'к', 'на'])
-stemmer = nltk.stem.snowball.RussianStemmer()
-stemmer.stopwords = set(stop_words)
 
 def tokenize_me(file_text):
-    #firstly let's apply nltk tokenization
     tokens = nltk.word_tokenize(file_text)
+    tokens = (i for i in tokens if i not in string.punctuation and i not in stop_words)
+    return set(stem(i.replace("«", "").replace("»", "")) for i in tokens)
+
+
+def count_words(comments):
+    counts = Counter()
+    for comment in comments:
+        counts.update(tokenize_me(comment))
+    return counts
+
+
+def read_batches(db, last_id, batch_size):
+    # Yields (<last _id of the batch>, <comments>)
+    query = {} if last_id is None else {'_id': {'$gt': last_id}}
+    cursor = db.find(query, {'comment': 1}).sort('_id', pymongo.ASCENDING).batch_size(batch_size)
+    batch, batch_last_id = [], None
+    for flat in cursor:
+        batch_last_id = flat['_id']
+        if flat.get('comment'):
+            batch.append(flat['comment'])
+        if len(batch) >= batch_size:
+            yield batch_last_id, batch
+            batch = []
+    if batch:
+        yield batch_last_id, batch
+
+
+def load_checkpoint(path):
+    with open(path) as f:
+        state = json.load(f)
+    return ObjectId(state['last_id']), state['documents'], Counter(state['counts'])
+
+
+def save_checkpoint(path, last_id, documents, counts):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'last_id': str(last_id), 'documents': documents, 'counts': counts}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
 
-    #let's delete punctuation symbols
-    tokens = [i for i in tokens if i not in string.punctuation]
 
-    #deleting stop_words
-    tokens = [i for i in tokens if i not in stop_words]
+def write_result(path, counts):
+    with open(path, 'w') as f:
+        for word, count in sorted(counts.items(), key=lambda x: (-x[1], x[0])):
+            f.write('{}\t{}\n'.format(word, count))
 
-    #cleaning words
-    tokens = [i.replace("«", "").replace("»", "") for i in tokens]
 
-    tokens = [stemmer.stem(i) for i in tokens]
+def main():
+    parser = argparse.ArgumentParser(description='Word statistics of flats comments')
+    parser.add_argument('-o', '--output', type=str, default='res.txt')
+    parser.add_argument('--checkpoint', type=str, default='get_texts.checkpoint.json')
+    parser.add_argument('--resume', action='store_true', help='Continue from the checkpoint')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--checkpoint-every', type=int, default=20, help='Batches between checkpoints')
+    parser.add_argument('--mongo', type=str, default='localhost')
+    args = parser.parse_args()
 
-    return set(tokens)
+    db = pymongo.MongoClient(args.mongo)['telegram_realty_bot_db']['flats']
+    last_id, documents, counts = None, 0, Counter()
+    if args.resume and os.path.exists(args.checkpoint):
+        last_id, documents, counts = load_checkpoint(args.checkpoint)
+        print("Resuming after {}, {} documents done".format(last_id, documents), file=sys.stderr)
+    total = db.estimated_document_count()
 
-comments = db.find({}, {'comment': 1})
-count = db.count({})
-words_dict = defaultdict(int)
+    start, resumed = time.time(), documents
+    batches = read_batches(db, last_id, args.batch_size)
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker) as executor:
+        # A few batches per worker in flight, the cursor is not read ahead further
+        futures = deque((batch_last_id, len(batch), executor.submit(count_words, batch))
+                        for batch_last_id, batch in islice(batches, args.workers * 2))
+        merged = 0
+        while futures:
+            batch_last_id, size, future = futures.popleft()
+            counts.update(future.result())
+            futures.extend((next_last_id, len(batch), executor.submit(count_words, batch))
+                           for next_last_id, batch in islice(batches, 1))
+            last_id = batch_last_id
+            documents += size
+            merged += 1
+            if merged % args.checkpoint_every == 0:
+                save_checkpoint(args.checkpoint, last_id, documents, counts)
+                rate = (documents - resumed) / max(time.time() - start, 1e-9)
+                print("{} of ~{} documents, {:.0f} per second".format(documents, total, rate), file=sys.stderr)
 
-for i, com in enumerate(comments):
-    print(i, count)
-    words = tokenize_me(com['comment'])
-    for word in words:
-        words_dict[word] += 1
+    if last_id is not None:
+        save_checkpoint(args.checkpoint, last_id, documents, counts)
+    write_result(args.output, counts)
+    print("{} documents, {} words in {:.1f} seconds".format(documents, len(counts), time.time() - start),
+          file=sys.stderr)
 
-with open('res.txt', 'w') as f:
-    for key, value in words_dict.items():
-        f.write('{} {}\n'.format(key, value))
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+
+from Benchmarks.Suite import run_suite
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def print_comparison(results: dict, baseline: dict):
+    print("{:<32} {:>12} {:>12} {:>8}".format("benchmark", "baseline, s", "current, s", "ratio"))
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['best_time'], result['best_time']
+        print("{:<32} {:>12.4f} {:>12.4f} {:>8.2f}".format(name, old, new, old / new if new else 0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Offline benchmarks of parser, matching and suspicious check')
+    parser.add_argument('--fixtures', type=str, default='url_responses',
+                        help='Directory with saved CIAN pages (debug_cian dumps)')
+    parser.add_argument('--synthetic-pages', type=int, default=50,
+                        help='Pages to generate when there are no fixtures')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--flats', type=int, default=5000)
+    parser.add_argument('--stations', type=int, default=200)
+    parser.add_argument('--matching-scale', type=str, default='10000x5000,100000x50000',
+                        help='Comma separated <users>x<flats> sizes of extra matching runs')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', type=str, default='benchmark_results.json')
+    parser.add_argument('--compare', type=str, help='Previous results JSON to compare with')
+    args = parser.parse_args()
+
+    matching_scale = [tuple(int(n) for n in size.split('x')) for size in args.matching_scale.split(',') if size]
+    results = run_suite(args.fixtures, args.synthetic_pages, args.users, args.flats, args.stations,
+                        args.repeat, args.seed, matching_scale)
+    report = {
+        'commit': get_commit(),
+        'date': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'params': vars(args),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    for name, result in results.items():
+        print("{:<32} {:>10.4f} s {:>14.1f} items/s {:>10.1f} KiB".format(
+            name, result['best_time'], result['items_per_sec'] or 0, result['peak_memory_bytes'] / 1024))
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f)['results'])
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import glob
+import os
+import random
+import time
+import tracemalloc
+from typing import Callable, List, Tuple
+
+import config
+from Benchmarks import Synthetic
+from GlobalManager.Filtering import match_flats_to_users, group_prices_by_station, select_suspicious_ids
+from Parsers import CianParser
+
+
+def measure(func: Callable[[], int], repeat: int) -> dict:
+    # func returns the number of processed items of one run. Timed runs go
+    # without tracemalloc, it slows Python code down several times.
+    times = []
+    items = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    best = min(times)
+    return {
+        'items': items,
+        'repeat': repeat,
+        'best_time': best,
+        'mean_time': sum(times) / len(times),
+        'items_per_sec': items / best if best > 0 else None,
+        'peak_memory_bytes': peak,
+    }
+
+
+def load_pages(fixtures_dir: str, synthetic_pages: int, rnd: random.Random) -> List[str]:
+    # Dumps written by get_url when config.debug_cian is on, or generated pages
+    pages = []
+    for path in sorted(glob.glob(os.path.join(fixtures_dir, '*.html'))):
+        with open(path) as f:
+            pages.append(f.read())
+    if not pages:
+        stations = Synthetic.get_stations(200)
+        pages = [Synthetic.generate_page(rnd, stations, first_id=i * 100) for i in range(synthetic_pages)]
+    return pages
+
+
+def bench_parse_pages(pages: List[str], backend: str, repeat: int) -> dict:
+    def run():
+        config.cian_html_backend = backend
+        offers = 0
+        for text in pages:
+            page = CianParser.parse_page(text)
+            offers += sum(1 for offer in CianParser.get_raw_offers(page)
+                          if CianParser.parse_raw_offer(offer) is not None)
+        return offers
+
+    result = measure(run, repeat)
+    result['pages'] = len(pages)
+    result['pages_per_sec'] = len(pages) / result['best_time'] if result['best_time'] > 0 else None
+    return result
+
+
+def bench_count_of_offers(pages: List[str], backend: str, repeat: int) -> dict:
+    config.cian_html_backend = backend
+    parsed = [CianParser.parse_page(text) for text in pages]
+
+    def run():
+        for page in parsed:
+            CianParser.get_count_of_offers(page)
+        return len(parsed)
+
+    return measure(run, repeat)
+
+
+def bench_change_params(count: int, repeat: int) -> dict:
+    urls = config.links_to_parse or ['http://www.cian.ru/cat.php?deal_type=rent&offer_type=flat&room1=1']
+
+    def run():
+        for i in range(count):
+            CianParser.change_params(urls[i % len(urls)], totime=3600, p=i % 50 + 1)
+        return count
+
+    return measure(run, repeat)
+
+
+def bench_parse_time(rnd: random.Random, count: int, repeat: int) -> dict:
+    strings = Synthetic.generate_time_strings(rnd, count)
+
+    def run():
+        for date, time_str in strings:
+            CianParser.parse_time(date, time_str)
+        return len(strings)
+
+    return measure(run, repeat)
+
+
+def bench_matching(rnd: random.Random, users: int, flats: int, stations: int, repeat: int) -> dict:
+    station_names = Synthetic.get_stations(stations)
+    flats = Synthetic.generate_flats(rnd, station_names, flats)
+    users = Synthetic.generate_users(rnd, station_names, users)
+
+    def run():
+        return sum(len(offers) for _, offers in match_flats_to_users(flats, users))
+
+    result = measure(run, repeat)
+    result['users'] = len(users)
+    result['flats'] = len(flats)
+    return result
+
+
+def bench_suspicious(rnd: random.Random, flats: int, stations: int, repeat: int) -> dict:
+    targets = Synthetic.generate_suspicious_targets(rnd, Synthetic.get_stations(stations), flats)
+
+    def run():
+        groups = group_prices_by_station((flat['metro'], flat['price'], flat['id']) for flat in targets)
+        sum(1 for _ in select_suspicious_ids(groups))
+        return len(targets)
+
+    return measure(run, repeat)
+
+
+def run_suite(fixtures_dir: str, synthetic_pages: int, users: int, flats: int, stations: int,
+              repeat: int, seed: int, matching_scale: List[Tuple[int, int]] = ()) -> dict:
+    rnd = random.Random(seed)
+    pages = load_pages(fixtures_dir, synthetic_pages, rnd)
+    initial_backend = config.cian_html_backend
+    results = {}
+    try:
+        for backend in ('bs4', 'lxml'):
+            results['parse_raw_offer[{}]'.format(backend)] = bench_parse_pages(pages, backend, repeat)
+            results['get_count_of_offers[{}]'.format(backend)] = bench_count_of_offers(pages, backend, repeat)
+    finally:
+        config.cian_html_backend = initial_backend
+    results['change_params'] = bench_change_params(10000, repeat)
+    results['parse_time'] = bench_parse_time(rnd, 10000, repeat)
+    results['new_links_update'] = bench_matching(rnd, users, flats, stations, repeat)
+    # Same matching on all-Moscow cycle sizes, items/s shows how it scales
+    for scale_users, scale_flats in matching_scale:
+        results['new_links_update[{}x{}]'.format(scale_users, scale_flats)] = \
+            bench_matching(rnd, scale_users, scale_flats, stations, repeat)
+    results['check_suspicious'] = bench_suspicious(rnd, flats, stations, repeat)
+    return results
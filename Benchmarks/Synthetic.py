@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import random
+from typing import List
+
+offer_row_template = """
+<tr class="offer_container">
+<td class="objects_item_info_col_1"><div class="objects_item_info_col_w"><input value="55.{id},37.{id}"/>
+<div class="objects_item_metro"><a href="#">м. {station}</a>
+<span class="objects_item_metro_comment"> {minutes} мин. пешком</span></div>
+<div class="objects_item_addr">Москва,</div><div class="objects_item_addr">ул. Тестовая, {id}</div></div></td>
+<td class="objects_item_info_col_2"><div class="objects_item_info_col_w">1-комн. кв.</div></td>
+<td class="objects_item_info_col_3"><div class="objects_item_info_col_w"><table>
+<tr><td>Общая: {area} м²</td></tr><tr><td>Кухня: 9 м²</td></tr></table></div></td>
+<td class="objects_item_info_col_4"><div class="objects_item_info_col_w"><div>{price} руб./мес.</div>
+<div class="objects_item_complaint">Пожаловаться</div><div>коммун. включены</div></div></td>
+<td class="objects_item_info_col_5"><div class="objects_item_info_col_w">50%</div></td>
+<td class="objects_item_info_col_6"><div class="objects_item_info_col_w">{floor}/9 этаж</div></td>
+<td class="objects_item_info_col_7"><div class="objects_item_info_col_w"><table>
+<tr><td>Мебель</td><td>Холодильник</td></tr></table></div></td>
+<td class="objects_item_info_col_8"><div class="objects_item_info_col_w"><a href="#">+7 999 000-00-00</a></div></td>
+<td class="objects_item_info_col_9"><div class="objects_item_info_col_w">
+<div class="objects_item_comment">Сдается квартира номер {id} <a href="https://www.cian.ru/rent/flat/{id}/">подробнее</a></div>
+<a href="/agents/?id_user={user}">Агент {user}</a> <span class="objects_item_dt_added">сегодня, 12:30</span>
+<div class="object_actions"><a href="#">Фото (7)</a></div></div></td>
+</tr>"""
+
+page_template = """<html><head><title>Снять квартиру — {count} объявлений</title></head>
+<body><table>{rows}</table></body></html>"""
+
+
+def get_stations(count: int) -> List[str]:
+    return ["Станция {}".format(i) for i in range(count)]
+
+
+def generate_page(rnd: random.Random, stations: List[str], first_id: int, rows: int = 28) -> str:
+    rows = "".join(offer_row_template.format(id=first_id + i,
+                                             station=rnd.choice(stations),
+                                             minutes=rnd.randint(1, 30),
+                                             area=rnd.randint(25, 60),
+                                             price="{:,}".format(rnd.randint(20, 120) * 1000).replace(',', ' '),
+                                             floor=rnd.randint(1, 9),
+                                             user=rnd.randint(1, 1000))
+                   for i in range(rows))
+    return page_template.format(count=rows.count('offer_container') * 10, rows=rows)
+
+
+def generate_flats(rnd: random.Random, stations: List[str], count: int) -> List[dict]:
+    # Shape of flats after GlobalParser.new_links_update sets their price
+    return [{'id': i,
+             'price': rnd.randint(20, 120) * 1000,
+             'location': {'metro': {'name': rnd.choice(stations)}}}
+            for i in range(count)]
+
+
+def generate_users(rnd: random.Random, stations: List[str], count: int,
+                   stations_per_user: int = 5) -> List[dict]:
+    lower_stations = [station.lower() for station in stations]
+    return [{'id': i,
+             'max_price': rnd.randint(20, 120) * 1000,
+             'metro_stations': rnd.sample(lower_stations, min(stations_per_user, len(lower_stations)))}
+            for i in range(count)]
+
+
+def generate_suspicious_targets(rnd: random.Random, stations: List[str], count: int) -> List[dict]:
+    # Fields SuspiciousChecker.get_target_flats reads from a flat, with the fixed price
+    return [{'id': i, 'price': rnd.randint(5, 120) * 1000, 'metro': rnd.choice(stations)}
+            for i in range(count)]
+
+
+def generate_time_strings(rnd: random.Random, count: int) -> List[tuple]:
+    dates = ['сегодня', 'вчера', '30 апр', '1 мая', '12 янв 2020']
+    return [(rnd.choice(dates), "{}:{:02}".format(rnd.randint(0, 23), rnd.randint(0, 59)))
+            for _ in range(count)]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+from typing import Iterable, Optional
+
+import config
+from . import Databases
+
+
+class CrawlWatermarksDB:
+    # Typical entry:
+    # {'url': <CANONICAL URL>,
+    # 'known_ids': <ids of the latest offers, newest first>,
+    # 'last_offer_time': <time of the newest offer>,
+    # 'updated': <Timestamp>}
+    db = Databases.get_crawl_watermarks_db()
+
+    @staticmethod
+    def get_known_ids(url) -> set:
+        watermark = CrawlWatermarksDB.db.find_one({'url': url}, {'known_ids': 1})
+        if watermark is None:
+            return set()
+        return set(watermark['known_ids'])
+
+    @staticmethod
+    def update(url, new_ids: Iterable[int], last_offer_time: Optional[datetime]):
+        watermark = CrawlWatermarksDB.db.find_one({'url': url}, {'known_ids': 1})
+        known_ids = list(new_ids)
+        if watermark is not None:
+            new_ids_set = set(known_ids)
+            known_ids.extend(i for i in watermark['known_ids'] if i not in new_ids_set)
+        update = {'known_ids': known_ids[:config.crawl_watermark_max_ids],
+                  'updated': datetime.utcnow()}
+        if last_offer_time is not None:
+            update['last_offer_time'] = last_offer_time
+        CrawlWatermarksDB.db.update_one({'url': url}, {'$set': update}, upsert=True)
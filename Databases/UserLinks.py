@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 import logging
+import uuid
 
+from pymongo import ASCENDING, UpdateOne
 from . import Databases
 from datetime import datetime, timedelta
-import time
 
 logger = logging.getLogger("LinksDBManager")
 
@@ -14,22 +15,9 @@ class LinksDBManager:
     # 'frequency': <TIME in secs>,
     # 'last_update': <Timestamp>,
     # 'next_update': <Timestamp>,
-    # 'type': <"CIAN", "Yandex", "Avito", etc.>}
+    # 'type': <"CIAN", "Yandex", "Avito", etc.>,
+    # 'lease_owner', 'lease_until', 'lease_token': set while an updates manager dispatches the link}
     links_db = Databases.get_user_links_db()
-    if links_db.count() > 0:
-        next_estimated_link_update = min(update['next_update'] for update in links_db.find())
-    else:
-        next_estimated_link_update = datetime.utcnow()
-
-    @staticmethod
-    def get_left_time_before_new_link_arrival():
-        now = datetime.utcnow()
-        if LinksDBManager.links_db.count() == 0:
-            LinksDBManager.next_estimated_link_update = datetime.utcnow() + timedelta(seconds=10)
-            return 10
-        if LinksDBManager.next_estimated_link_update > now:
-            return (LinksDBManager.next_estimated_link_update - now).seconds
-        return 0
 
     @staticmethod
     def get_user_links(user_id):
@@ -37,12 +25,14 @@ class LinksDBManager:
 
     @staticmethod
     def add_user_link(user_id, url, tag, frequency, link_type):
+        # A new link is due at once, its first results come within seconds
+        now = datetime.utcnow()
         res = LinksDBManager.links_db.insert_one({'id': user_id,
                                                   'url': url,
                                                   'tag': tag,
                                                   'frequency': frequency,
-                                                  'last_update': datetime.utcnow(),
-                                                  'next_update': datetime.utcnow() + timedelta(minutes=frequency),
+                                                  'last_update': now,
+                                                  'next_update': now,
                                                   'type': link_type})
         return LinksDBManager.links_db.find_one({'_id': res.inserted_id})
 
@@ -58,28 +48,37 @@ class LinksDBManager:
                                                                                 "next_update": next_update}})
 
     @staticmethod
-    def get_expired_links():
-        if LinksDBManager.links_db.count() and datetime.utcnow() >= LinksDBManager.next_estimated_link_update:
-            logger.debug("Querying database for new links")
-            LinksDBManager.next_estimated_link_update = None
-            for update in list(LinksDBManager.links_db.find({'next_update': {"$lte": datetime.utcnow()}})):
-                LinksDBManager.update_expiration_time(update['_id'])
-                yield update
-            if LinksDBManager.next_estimated_link_update is None:
-                LinksDBManager.next_estimated_link_update = datetime.utcnow()
-        else:
-            return []
+    def get_schedule(user_id=None):
+        # (_id, user id, next_update) of all links or of one user's links, served by update_index
+        query = {} if user_id is None else {'id': user_id}
+        return LinksDBManager.links_db.find(query, {'_id': 1, 'id': 1, 'next_update': 1}) \
+            .sort('next_update', ASCENDING)
+
+    @staticmethod
+    def get_links(unique_ids, projection=None):
+        return LinksDBManager.links_db.find({'_id': {'$in': list(unique_ids)}}, projection)
+
+    @staticmethod
+    def claim_links(unique_ids, owner, now, lease_seconds):
+        # Atomically leases the due links nobody else holds. Several updates
+        # managers may try the same links, each link is claimed by one of them.
+        token = uuid.uuid4().hex
+        LinksDBManager.links_db.update_many({'_id': {'$in': list(unique_ids)},
+                                             'next_update': {'$lte': now},
+                                             '$or': [{'lease_until': {'$exists': False}},
+                                                     {'lease_until': {'$lte': now}}]},
+                                            {'$set': {'lease_owner': owner,
+                                                      'lease_until': now + timedelta(seconds=lease_seconds),
+                                                      'lease_token': token}})
+        return token, list(LinksDBManager.links_db.find({'lease_token': token}))
 
     @staticmethod
-    def update_expiration_time(unique_id):
-        update = LinksDBManager.links_db.find_one({"_id": unique_id})
-        now_time = datetime.utcnow()
-        next_time = datetime.utcnow() + timedelta(minutes=update['frequency'])
-        if LinksDBManager.next_estimated_link_update is None \
-                or LinksDBManager.next_estimated_link_update > next_time:
-            LinksDBManager.next_estimated_link_update = next_time
-        return LinksDBManager.links_db.update_one({"_id": unique_id},
-                                                  {"$set": {
-                                                      'last_update': now_time,
-                                                      "next_update": next_time,
-                                                  }})
+    def reschedule(links, token):
+        # Sets last_update and next_update of the dispatched links and releases
+        # their lease in one round trip. A lease that expired and was taken over is left alone.
+        requests = [UpdateOne({'_id': link['_id'], 'lease_token': token},
+                              {'$set': {'last_update': link['last_update'], 'next_update': link['next_update']},
+                               '$unset': {'lease_owner': '', 'lease_until': '', 'lease_token': ''}})
+                    for link in links]
+        if requests:
+            LinksDBManager.links_db.bulk_write(requests, ordered=False)
@@ -11,8 +11,25 @@ class Databases:
 
     mongo[config.user_links_db].create_index([('id', ASCENDING)], name="user_links_index")
     mongo[config.user_links_db].create_index([('next_update', ASCENDING)], name="update_index")
+    mongo[config.user_links_db].create_index([('lease_token', ASCENDING)], sparse=True, name="lease_token_index")
 
     mongo[config.flats_db].create_index([('id', ASCENDING)], unique=True, name="flat_id_index")
+    mongo[config.flats_db].create_index([('location.metro.name', ASCENDING), ('price_rub', ASCENDING)],
+                                        name="flat_metro_price_index")
+    mongo[config.flats_db].create_index([('price_rub', ASCENDING)], name="flat_price_index")
+    mongo[config.flats_db].create_index([('area_total', ASCENDING)], name="flat_area_index")
+    mongo[config.flats_db].create_index([('floor_num', ASCENDING)], name="flat_floor_index")
+    mongo[config.flats_db].create_index([('time', ASCENDING)], name="flat_time_index")
+
+    mongo[config.crawl_watermarks_db].create_index([('url', ASCENDING)], unique=True, name="watermark_url_index")
+    mongo[config.duplicate_buckets_db].create_index([('band', ASCENDING)], unique=True, name="duplicate_band_index")
+    mongo[config.duplicate_buckets_db].create_index([('updated', ASCENDING)], expireAfterSeconds=config.duplicates_ttl,
+                                                    name="duplicate_band_ttl_index")
+    mongo[config.duplicate_clusters_db].create_index([('cluster', ASCENDING)], unique=True,
+                                                     name="duplicate_cluster_index")
+    mongo[config.duplicate_clusters_db].create_index([('updated', ASCENDING)], expireAfterSeconds=config.duplicates_ttl,
+                                                     name="duplicate_cluster_ttl_index")
+    mongo[config.price_sketches_db].create_index([('station', ASCENDING)], unique=True, name="sketch_station_index")
 
     @staticmethod
     def get_users_db():
@@ -29,3 +46,19 @@ class Databases:
     @staticmethod
     def get_user_links_db():
         return Databases.mongo[config.user_links_db]
+
+    @staticmethod
+    def get_crawl_watermarks_db():
+        return Databases.mongo[config.crawl_watermarks_db]
+
+    @staticmethod
+    def get_duplicate_buckets_db():
+        return Databases.mongo[config.duplicate_buckets_db]
+
+    @staticmethod
+    def get_duplicate_clusters_db():
+        return Databases.mongo[config.duplicate_clusters_db]
+
+    @staticmethod
+    def get_price_sketches_db():
+        return Databases.mongo[config.price_sketches_db]
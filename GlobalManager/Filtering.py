@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Pure matching and filtering steps of the all-Moscow cycle, kept free of
+# database access so they can be benchmarked offline
+import heapq
+import math
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
+from typing import Dict, Iterable, List, Tuple
+
+import config
+
+
+class FlatsIndex:
+    # Flats of one batch grouped by lowercased station name, every group
+    # sorted by price. A user's matches are the cheap prefixes of their
+    # stations' groups found with bisect, so matching costs
+    # O(stations of the user * log(flats)) plus the size of the answer.
+    # flats: {'id', 'price': <int>, 'location': {'metro': {'name'}}}
+    def __init__(self, flats: List[dict]):
+        by_station = defaultdict(list)
+        for position, flat in enumerate(flats):
+            by_station[flat['location']['metro']['name'].lower()].append((flat['price'], position, flat['id']))
+        self.prices: Dict[str, List[int]] = {}
+        # Flat ids in the order of prices
+        self.ids: Dict[str, List[int]] = {}
+        for station, entries in by_station.items():
+            entries.sort()
+            self.prices[station] = [price for price, _, _ in entries]
+            self.ids[station] = [flat_id for _, _, flat_id in entries]
+        self.min_price = min((prices[0] for prices in self.prices.values()), default=None)
+
+    @property
+    def stations(self) -> List[str]:
+        return list(self.prices.keys())
+
+    def match(self, stations: Iterable[str], max_price: int) -> List[int]:
+        # Ids of matching flats, grouped by station and cheapest first
+        matched = []
+        for station in set(stations):
+            prices = self.prices.get(station)
+            if prices is None:
+                continue
+            matched.extend(self.ids[station][:bisect_right(prices, max_price)])
+        return matched
+
+    def match_users(self, users: Iterable[dict]) -> Iterable[Tuple[int, List[int]]]:
+        # users: {'id', 'max_price', 'metro_stations'}
+        for user in users:
+            good_flats = self.match(user['metro_stations'], user['max_price'])
+            if len(good_flats) > 0:
+                yield user['id'], good_flats
+
+
+def match_flats_to_users(flats: List[dict], users: Iterable[dict]) -> Iterable[Tuple[int, List[int]]]:
+    return FlatsIndex(flats).match_users(users)
+
+
+def group_prices_by_station(flats: Iterable[Tuple[str, int, int]]) -> Dict[str, Tuple[array, array]]:
+    # flats: (<station name>, <price>, <id>), read in one pass. Prices and
+    # ids are kept in typed arrays, 16 bytes per flat instead of a dict.
+    groups = {}
+    for station, price, flat_id in flats:
+        station = station.lower()
+        group = groups.get(station)
+        if group is None:
+            group = groups[station] = (array('q'), array('q'))
+        group[0].append(price)
+        group[1].append(flat_id)
+    return groups
+
+
+def select_suspicious_ids(groups: Dict[str, Tuple[array, array]]) -> Iterable[int]:
+    # The cheapest suspicious_fraction of every station
+    for prices, ids in groups.values():
+        suspicious_num = math.ceil(len(prices) * config.suspicious_fraction)
+        for _, flat_id in heapq.nsmallest(suspicious_num, zip(prices, ids)):
+            yield flat_id
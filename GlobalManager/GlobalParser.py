@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 import logging
+import queue
 import time
-import string
-from typing import Callable, List
+import uuid
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Set
 import threading
 
 import config
 from Databases import Databases
+from GlobalManager.Filtering import FlatsIndex
+from Parsers.Prices import get_price_rub
 from Queues import QueueWrapper
 from Queues.ProducerConsumer.ConsumerFactory import ConsumerFactory
 from Queues.StraightQueue import StraightQueue
@@ -15,90 +19,141 @@ logger = logging.getLogger("GlobalParser")
 
 
 class GlobalParser:
-    links_res = {}
-    parse_request_function: Callable[[int, dict], None] = None
+    # Links of the current cycle not answered yet: <LINK INDEX>: <deadline timestamp>
+    links_pending: Dict[int, float] = {}
+    cycle: Optional[str] = None
+    # Offers sent to every user during the current cycle: <UID>: <set of ids>
+    sent_offers: Dict[int, Set[int]] = defaultdict(set)
+    # Answers waiting to be matched by the GlobalParser thread:
+    # (<info>, <offer ids>, <sent_offers of its cycle or None>), None wakes it up to close
+    answers: queue.Queue = queue.Queue()
+    lock = threading.Lock()
+    parse_request_function: Callable[[dict, dict], None] = None
     offers_send_function: Callable[[dict], None] = None
     need_close = False
     thread: threading.Thread = None
-    flats_ids: List[int] = []
 
     @staticmethod
-    def fix_price(flat):
-        price = flat['price'][0]
-        price = "".join(c for c in price if c in string.digits)
-        return int(price)
-
-    @staticmethod
-    def new_links_update():
-        if len(GlobalParser.flats_ids) == 0:
+    def new_links_update(flats_ids: List[int], sent_offers: Optional[Dict[int, Set[int]]] = None):
+        # sent_offers: offers already sent in this cycle, they are not sent twice
+        if len(flats_ids) == 0:
             return
         logger.info("Filtering offers and sending them to queue")
         # Filter ids from duplicates
-        flats = set(GlobalParser.flats_ids)
-        # Get these flats from DB
+        flats = set(flats_ids)
+        # Get these flats from DB, scam-priced ones aren't sent
         flats = list(Databases.get_flats_db().find({'id': {'$in': list(flats)},
-                                                    'location.metro': {'$exists': True}},
+                                                    'location.metro': {'$exists': True},
+                                                    'suspicious': {'$ne': True}},
                                                    {'id': 1,
                                                     'location.metro.name': 1,
-                                                    'price': 1}))
+                                                    'price': 1,
+                                                    'price_rub': 1}))
         for flat in flats:
-            flat['price'] = GlobalParser.fix_price(flat)
-        # Get all users with their fields
-        users = Databases.get_users_db().find({'max_price': {'$exists': True},
-                                               'metro_stations': {'$exists': True}},
+            flat['price'] = get_price_rub(flat)
+        # Flats priced in other currencies can't be compared with users' limits
+        flats = [flat for flat in flats if flat['price'] is not None]
+        if len(flats) == 0:
+            return
+        index = FlatsIndex(flats)
+        # Only users having a station of the batch and a price limit above
+        # its cheapest flat can match anything
+        users = Databases.get_users_db().find({'max_price': {'$exists': True, '$gte': index.min_price},
+                                               'metro_stations': {'$exists': True, '$in': index.stations}},
                                               {'id': 1,
                                                'max_price': 1,
                                                'metro_stations': 1})
         # For each user filter links they need
-        for user in users:
-            user_id = user['id']
-            user_max_price = user['max_price']
-            user_stations = set(user['metro_stations'])
-            # Filter by stations
-            good_flats = (flat for flat in flats if flat['location']['metro']['name'].lower() in user_stations)
-            good_flats = (flat for flat in good_flats if flat['price'] <= user_max_price)
-            good_flats = list(good_flats)
-            if len(good_flats) > 0:
-                message = {
-                    'uid': user_id,
-                    'offers': [flat['id'] for flat in good_flats],
-                }
-                logger.debug("Sending {} offers to user {}".format(len(good_flats), user_id))
-                GlobalParser.offers_send_function(message)
+        for user_id, offers in index.match_users(users):
+            if sent_offers is not None:
+                with GlobalParser.lock:
+                    user_sent = sent_offers[user_id]
+                    offers = [offer for offer in offers if offer not in user_sent]
+                    user_sent.update(offers)
+                if len(offers) == 0:
+                    continue
+            message = {
+                'uid': user_id,
+                'offers': offers,
+            }
+            logger.debug("Sending {} offers to user {}".format(len(offers), user_id))
+            GlobalParser.offers_send_function(message)
 
     @staticmethod
     def link_parsed(info, result) -> bool:
-        if not GlobalParser.need_close:
-            if info in GlobalParser.links_res.keys():
-                GlobalParser.links_res[info] = True
-            GlobalParser.flats_ids.extend(result)
-            logger.debug("Parsed {} offers".format(len(result)))
-            return True
-        return False
+        # Called in the consuming thread: only the cycle bookkeeping is done here,
+        # matching and sending would hold up heartbeats of the connection
+        if GlobalParser.need_close:
+            return False
+        with GlobalParser.lock:
+            current = isinstance(info, dict) and info.get('cycle') == GlobalParser.cycle
+            if current:
+                if GlobalParser.links_pending.pop(info['link'], None) is None:
+                    logger.warning("Link {} answered after its timeout".format(info['link']))
+            else:
+                logger.debug("Got an answer of a previous cycle: {}".format(info))
+            sent_offers = GlobalParser.sent_offers if current else None
+            # Queued under the lock, so the cycle isn't seen done before its last answer is matched
+            GlobalParser.answers.put((info, result, sent_offers))
+        return True
+
+    @staticmethod
+    def match_answer(timeout: float) -> bool:
+        # Matches one queued answer, False if none came in timeout seconds
+        try:
+            answer = GlobalParser.answers.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        if answer is None:
+            return False
+        info, result, sent_offers = answer
+        logger.debug("Parsed {} offers".format(len(result)))
+        GlobalParser.new_links_update(result, sent_offers)
+        return True
+
+    @staticmethod
+    def drop_expired_links():
+        now = time.time()
+        with GlobalParser.lock:
+            expired = [link for link, deadline in GlobalParser.links_pending.items() if deadline <= now]
+            for link in expired:
+                logger.warning("Link {} didn't answer in {} seconds".format(link, config.all_moscow_link_timeout))
+                del GlobalParser.links_pending[link]
+
+    @staticmethod
+    def wait_cycle():
+        # Matches answers until every link of the cycle is answered or timed out
+        while not GlobalParser.need_close:
+            with GlobalParser.lock:
+                if not GlobalParser.links_pending and GlobalParser.answers.empty():
+                    return
+                deadline = min(GlobalParser.links_pending.values(), default=time.time())
+            if not GlobalParser.match_answer(max(deadline - time.time(), 0)):
+                GlobalParser.drop_expired_links()
 
     @staticmethod
-    def safe_sleep(seconds):
-        left = seconds
-        while not GlobalParser.need_close and left > 0:
-            left -= 1
-            time.sleep(1)
+    def sleep(seconds: float):
+        # Late answers of the previous cycle are still matched while sleeping
+        end = time.time() + seconds
+        while not GlobalParser.need_close and time.time() < end:
+            GlobalParser.match_answer(max(end - time.time(), 0))
 
     @staticmethod
     def work():
         while not GlobalParser.need_close:
             logger.debug("Started parsing process")
-            GlobalParser.flats_ids = []
-            GlobalParser.links_res = dict()
+            cycle = uuid.uuid4().hex
+            deadline = time.time() + config.all_moscow_link_timeout
+            with GlobalParser.lock:
+                GlobalParser.cycle = cycle
+                GlobalParser.sent_offers = defaultdict(set)
+                GlobalParser.links_pending = {i: deadline for i in range(len(config.links_to_parse))}
             for i, link in enumerate(config.links_to_parse):
-                GlobalParser.links_res[i] = False
-                GlobalParser.parse_request_function(i, {'url': link, 'time': 0})
-            while not GlobalParser.need_close and \
-                    not all(GlobalParser.links_res.values()):
-                logger.debug("Waiting 10 seconds for new links result")
-                GlobalParser.safe_sleep(10)
-            GlobalParser.new_links_update()
+                GlobalParser.parse_request_function({'cycle': cycle, 'link': i},
+                                                    {'url': link, 'time': 0, 'incremental': True})
+            GlobalParser.wait_cycle()
             logger.debug("Sleeping {} seconds".format(config.parser_wait_time))
-            GlobalParser.safe_sleep(config.parser_wait_time)
+            GlobalParser.sleep(config.parser_wait_time)
 
     @staticmethod
     def register():
@@ -113,4 +168,5 @@ class GlobalParser:
     @staticmethod
     def close_thread():
         GlobalParser.need_close = True
+        GlobalParser.answers.put(None)
         GlobalParser.thread.join()
@@ -1,16 +1,19 @@
 # -*- coding: utf-8 -*-
 import logging
+import resource
 import threading
 import time
-from datetime import datetime
-
-import string
-
-import math
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Iterable, Tuple
 
 import config
 import pytz
+from pymongo import UpdateMany
 from Databases import Databases
+from GlobalManager.Filtering import group_prices_by_station, select_suspicious_ids
+from Parsers.PriceSketches import PriceSketches
+from Parsers.Prices import get_price_rub
 
 logger = logging.getLogger("Suspicious checker")
 
@@ -43,41 +46,63 @@ class SuspiciousChecker:
             time.sleep(1)
 
     @staticmethod
-    def fix_price(flat):
-        price = flat['price'][0]
-        price = "".join(c for c in price if c in string.digits)
-        return int(price)
+    def get_target_flats(db) -> Iterable[Tuple[str, int, int]]:
+        # Streams (<station>, <price>, <id>) of the flats not checked yet
+        cursor = db.find({'seen_by_suspicious_validator': False,
+                          'location.metro': {'$exists': True}},
+                         {'_id': 0,
+                          'id': 1,
+                          'price': 1,
+                          'price_rub': 1,
+                          'location.metro.name': 1}).batch_size(config.suspicious_check_batch_size)
+        for flat in cursor:
+            price = get_price_rub(flat)
+            if price is not None:
+                yield flat['location']['metro']['name'], price, flat['id']
+
+    @staticmethod
+    def write_flags(db, ids: Iterable[int], flags: dict) -> int:
+        # Bounded $in lists, so no command comes near the BSON size limit
+        written = 0
+        ids = iter(ids)
+        while True:
+            chunk = list(islice(ids, config.suspicious_check_write_chunk))
+            if not chunk:
+                return written
+            db.bulk_write([UpdateMany({'id': {'$in': chunk}}, {'$set': flags})], ordered=False)
+            written += len(chunk)
 
     @staticmethod
     def check_suspicious():
         logger.info("Checking suspicious")
+        start = time.monotonic()
         db = Databases.get_flats_db()
         logger.debug("Getting target flats")
-        target_flats = list(db.find({'seen_by_suspicious_validator': False,
-                                     'location.metro': {'$exists': True}},
-                                    {'id': 1,
-                                     'price': 1,
-                                     'location.metro.name': 1}))
-        logger.debug("Got {}".format(len(target_flats)))
-        for flat in target_flats:
-            flat['price'] = SuspiciousChecker.fix_price(flat)
-            flat['metro'] = flat['location']['metro']['name']
-            del flat['location']
-        logger.debug("Fixed names")
-        suspicious_flats = []
-        stations = set(flat['metro'].lower() for flat in target_flats)
-        logger.debug("Getting suspicious flats")
-        for station in stations:
-            station_flats = [flat for flat in target_flats if flat['metro'].lower() == station]
-            suspicious_num = math.ceil(len(station_flats) * config.suspicious_fraction)
-            station_flats.sort(key=lambda x: x['price'])
-            suspicious_flats.extend(station_flats[:suspicious_num])
-
-        target_flats_ids = [flat['id'] for flat in target_flats]
-        suspicious_flats_ids = [flat['id'] for flat in suspicious_flats]
+        groups = group_prices_by_station(SuspiciousChecker.get_target_flats(db))
+        read_time = time.monotonic() - start
+        logger.debug("Got {} flats of {} stations".format(sum(len(ids) for _, ids in groups.values()), len(groups)))
         logger.debug("Pushing to DB")
-        db.update_many({'id': {'$in': target_flats_ids}}, {'$set': {'seen_by_suspicious_validator': True}})
-        db.update_many({'id': {'$in': suspicious_flats_ids}}, {'$set': {'suspicious': True}})
+        # Suspicious flags go first: flats are marked seen only after their flag is stored
+        suspicious = SuspiciousChecker.write_flags(db, select_suspicious_ids(groups), {'suspicious': True})
+        target = SuspiciousChecker.write_flags(db, (flat_id for _, ids in groups.values() for flat_id in ids),
+                                               {'seen_by_suspicious_validator': True})
+        total_time = time.monotonic() - start
+        logger.info("Checked {} flats, {} suspicious, in {:.1f} s (reading {:.1f} s, {:.0f} flats/s), "
+                    "peak RSS {} MiB".format(target, suspicious, total_time, read_time,
+                                             target / total_time if total_time > 0 else 0,
+                                             resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024))
+        SuspiciousChecker.recalibrate_sketches()
+
+    @staticmethod
+    def recalibrate_sketches():
+        # Offers are classified at ingest time against the price sketches,
+        # this pass only keeps them in line with the recent market
+        logger.info("Rebuilding price sketches")
+        since = datetime.utcnow() - timedelta(days=config.price_sketch_window_days)
+        flats = Databases.get_flats_db().find({'time': {'$gte': since},
+                                               'location.metro': {'$exists': True}},
+                                              {'price_rub': 1, 'location.metro.name': 1})
+        PriceSketches(Databases.get_price_sketches_db()).rebuild(flats)
 
     @staticmethod
     def work():
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# One-shot backfill of the numeric fields (price_rub, area_*, floor_*)
+# for flats stored before parse_raw_offer started emitting them
+from pymongo import UpdateOne
+
+from Databases import Databases
+from Parsers.CianParser import normalize_offer
+
+batch_size = 1000
+
+if __name__ == "__main__":
+    db = Databases.get_flats_db()
+    flats = db.find({'price_rub': {'$exists': False}},
+                    {'_id': 1, 'price': 1, 'sizes': 1, 'floor': 1}).batch_size(batch_size)
+    requests = []
+    total = 0
+    for flat in flats:
+        requests.append(UpdateOne({'_id': flat['_id']}, {'$set': normalize_offer(flat)}))
+        if len(requests) >= batch_size:
+            db.bulk_write(requests, ordered=False)
+            total += len(requests)
+            requests = []
+            print("Normalized {} flats".format(total))
+    if requests:
+        db.bulk_write(requests, ordered=False)
+        total += len(requests)
+    print("Done. Normalized {} flats".format(total))
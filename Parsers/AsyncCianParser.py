@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import math
+import time
+from typing import AsyncIterator, Dict, Iterable, List, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+from aiohttp_socks import ProxyConnector
+from bs4 import BeautifulSoup as bs
+
+import config
+from Parsers import CianParser, ParsePool
+from Parsers.MyRequestsCacher import MyRequestsCacher
+from Parsers.UrlCheckCache import UrlCheckCache
+from Parsers.CianParser import Offer, change_params, get_raw_offers, parse_raw_offer, get_count_of_offers, \
+    is_known_page, proxy_pool
+
+logger = logging.getLogger("AsyncCianParser")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncCianParser:
+    # Must be created inside a running event loop
+    def __init__(self):
+        self.sessions: Dict[Optional[str], aiohttp.ClientSession] = {}
+        self.host_buckets: Dict[str, TokenBucket] = {}
+        self.proxy_buckets: Dict[Optional[str], TokenBucket] = {}
+        self.in_flight = asyncio.Semaphore(config.cian_async_max_in_flight)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        sessions = list(self.sessions.values())
+        self.sessions = {}
+        for session in sessions:
+            await session.close()
+
+    def get_session(self, proxy: Optional[str]) -> aiohttp.ClientSession:
+        if proxy not in self.sessions:
+            if proxy:
+                # aiohttp_socks resolves names on the proxy side with rdns
+                proxy_url = CianParser.parse_proxies(proxy)['http'].replace('socks5h://', 'socks5://', 1)
+                connector = ProxyConnector.from_url(proxy_url, rdns=True,
+                                                    limit=config.cian_max_requests_per_proxy)
+            else:
+                connector = aiohttp.TCPConnector(limit=config.cian_max_requests_per_host)
+            self.sessions[proxy] = aiohttp.ClientSession(
+                connector=connector,
+                cookies=CianParser.table_cookies,
+                timeout=aiohttp.ClientTimeout(total=config.cian_request_timeout),
+            )
+        return self.sessions[proxy]
+
+    def get_host_bucket(self, url: str) -> TokenBucket:
+        host = urlparse(url).hostname
+        if host not in self.host_buckets:
+            self.host_buckets[host] = TokenBucket(config.cian_async_host_rate, config.cian_async_host_burst)
+        return self.host_buckets[host]
+
+    def get_proxy_bucket(self, proxy: Optional[str]) -> TokenBucket:
+        if proxy not in self.proxy_buckets:
+            self.proxy_buckets[proxy] = TokenBucket(config.cian_async_proxy_rate, config.cian_async_proxy_burst)
+        return self.proxy_buckets[proxy]
+
+    async def fetch_url(self, url: str, proxy: str = None) -> Optional[str]:
+        loop = asyncio.get_event_loop()
+        # Disk I/O of the responses cache stays off the event loop
+        text = await loop.run_in_executor(None, MyRequestsCacher.get, url)
+        if text is not None or MyRequestsCacher.is_offline():
+            return text
+        try:
+            await self.get_host_bucket(url).acquire()
+            await self.get_proxy_bucket(proxy).acquire()
+            async with self.in_flight:
+                start = time.monotonic()
+                async with self.get_session(proxy).get(url) as r:
+                    text = await r.text()
+                    status = r.status
+                latency = time.monotonic() - start
+            if not CianParser.check_response(status, text):
+                proxy_pool.report_failure(proxy, captcha=CianParser.is_captcha(text))
+                return None
+            proxy_pool.report_success(proxy, latency)
+            await loop.run_in_executor(None, MyRequestsCacher.put, url, text)
+            return text
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            proxy_pool.report_failure(proxy)
+            logger.debug(f'Proxy: {proxy}.\nCian connection error: {e}')
+            return None
+
+    async def safe_fetch(self, url) -> str:
+        for _ in range(config.cian_trials_before_none):
+            candidates = proxy_pool.get_candidates()
+            if not candidates:
+                wait_time = min(proxy_pool.time_until_available(), config.cian_proxy_max_wait)
+                logger.warning("All proxies are cooling down. Waiting {:.1f} seconds".format(wait_time))
+                await asyncio.sleep(wait_time)
+                continue
+            for proxy in candidates:
+                text = await self.fetch_url(url, proxy)
+                if text is not None:
+                    logger.debug(f"Request was successful! Proxy: {proxy or 'no proxy'}")
+                    return text
+                logger.warning(f"Request wasn't successful! Proxy: {proxy or 'no proxy'}")
+        raise Exception("Total request didn't succeed :<")
+
+    async def safe_request(self, url) -> bs:
+        return CianParser.parse_page(await self.request_page(url))
+
+    async def request_page(self, url) -> str:
+        return await asyncio.wait_for(self.safe_fetch(url), config.cian_async_page_timeout)
+
+    async def parse_offers(self, text: str) -> List[dict]:
+        # CPU-bound parsing is moved off the event loop when parse workers are enabled
+        if not ParsePool.ParsePool.is_enabled():
+            return ParsePool.parse_page_offers(text)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(ParsePool.ParsePool.get_executor(), ParsePool.parse_page_offers, text)
+
+    async def check_url_correct(self, url: str) -> bool:
+        key = CianParser.canonicalize_url(url)
+        cached = UrlCheckCache.get(key)
+        if cached is not None:
+            return cached
+        if CianParser.cian_url not in url:
+            UrlCheckCache.put(key, False)
+            return False
+        try:
+            page_bs = await self.safe_request(change_params(url, totime=3000, p=1))
+            raw_offers = get_raw_offers(page_bs)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            return False
+        result = bool(len(raw_offers))
+        UrlCheckCache.put(key, result)
+        return result
+
+    async def get_offers(self, raw_url: str, url_time: int,
+                         known_ids: Optional[set] = None) -> AsyncIterator[Offer]:
+        page_bs = await self.safe_request(change_params(raw_url, totime=url_time, p=1))
+        num_of_offers = get_count_of_offers(page_bs)
+        logger.debug("Parsing {} offers".format(num_of_offers))
+        if num_of_offers == 0:
+            return
+        raw_offers = get_raw_offers(page_bs)
+        if len(raw_offers) > 0:
+            UrlCheckCache.put(CianParser.canonicalize_url(raw_url), True)
+        offers = [parse_raw_offer(offer) for offer in raw_offers]
+        pages_num = 1
+        if len(raw_offers) > 0:
+            pages_num += math.ceil(max(num_of_offers - len(raw_offers), 0) / len(raw_offers))
+        if is_known_page(offers, known_ids):
+            logger.info("Page 1 is already known. Fetched 1 of {} pages".format(pages_num))
+            return
+        for offer in offers:
+            yield offer
+        if pages_num == 1:
+            return
+        if known_ids:
+            # Incremental crawls usually stop after a page or two: pages go one
+            # by one, so none is fetched past the first known page
+            for i in range(2, pages_num + 1):
+                text = await self.request_page(change_params(raw_url, totime=url_time, p=i))
+                logger.debug("Parsing {} page".format(i))
+                offers = await self.parse_offers(text)
+                if is_known_page(offers, known_ids):
+                    logger.info("Page {} is already known. Fetched {} of {} pages".format(i, i, pages_num))
+                    return
+                for offer in offers:
+                    yield offer
+            return
+        # All remaining pages are put in flight at once, the buckets and
+        # the in-flight semaphore keep the actual load bounded
+        tasks = [asyncio.ensure_future(self.request_page(change_params(raw_url, totime=url_time, p=i)))
+                 for i in range(2, pages_num + 1)]
+        try:
+            for i, task in enumerate(tasks, start=2):
+                text = await task
+                logger.debug("Parsing {} page".format(i))
+                offers = await self.parse_offers(text)
+                for offer in offers:
+                    yield offer
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def get_offers_sync(raw_url: str, url_time: int, known_ids: Optional[set] = None) -> Iterable[Offer]:
+    # Thin blocking wrapper, so the rest of the parser service stays synchronous
+    loop = asyncio.new_event_loop()
+
+    async def create_parser():
+        return AsyncCianParser()
+
+    parser = loop.run_until_complete(create_parser())
+    offers = parser.get_offers(raw_url, url_time, known_ids)
+    try:
+        while True:
+            try:
+                offer = loop.run_until_complete(offers.__anext__())
+            except StopAsyncIteration:
+                break
+            yield offer
+    finally:
+        loop.run_until_complete(offers.aclose())
+        loop.run_until_complete(parser.close())
+        loop.close()
+
+
+def check_url_correct_sync(url: str) -> bool:
+    async def check():
+        async with AsyncCianParser() as parser:
+            return await parser.check_url_correct(url)
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(check())
+    finally:
+        loop.close()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# lxml backend of the CIAN table parser. Produces exactly the same
+# offer dicts as CianParser.parse_raw_offer, but walks the tree with
+# precompiled XPath instead of BeautifulSoup matchers.
+import logging
+import re
+
+import lxml.html
+from lxml import etree
+
+from Parsers import CianParser
+
+logger = logging.getLogger("CianLxmlParser")
+
+
+def has_class(name: str) -> str:
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(name)
+
+
+offer_rows_xpath = etree.XPath("//tr[{}]".format(has_class('offer_container')))
+title_xpath = etree.XPath("//title")
+not_found_xpath = etree.XPath("//div[{}]".format(has_class('serps-header_nothing-found__title')))
+
+info_w_xpath = etree.XPath(".//div[{}]".format(has_class('objects_item_info_col_w')))
+input_xpath = etree.XPath(".//input")
+metro_xpath = etree.XPath(".//div[{}]".format(has_class('objects_item_metro')))
+link_xpath = etree.XPath(".//a")
+metro_comment_xpath = etree.XPath(".//span[{}]".format(has_class('objects_item_metro_comment')))
+address_xpath = etree.XPath(".//div[{}]".format(has_class('objects_item_addr')))
+td_xpath = etree.XPath(".//td")
+div_xpath = etree.XPath(".//div")
+comment_xpath = etree.XPath(".//div[contains(@class, 'comment')]")
+href_xpath = etree.XPath(".//a[@href]")
+user_link_xpath = etree.XPath(".//a[contains(@href, 'id_user')]")
+time_added_xpath = etree.XPath(".//span[{}]".format(has_class('objects_item_dt_added')))
+actions_xpath = etree.XPath(".//div[{}]".format(has_class('object_actions')))
+
+
+def is_lxml_node(node) -> bool:
+    return isinstance(node, etree._Element)
+
+
+def parse_page(text: str) -> lxml.html.HtmlElement:
+    return lxml.html.document_fromstring(text)
+
+
+def first(nodes):
+    return nodes[0] if nodes else None
+
+
+def fix_text(node) -> str:
+    if node is None:
+        return ''
+    if is_lxml_node(node):
+        node = node.text_content()
+    return ' '.join(node.split())
+
+
+def get_classes(node) -> list:
+    return node.get('class', '').split()
+
+
+def is_price_div(node) -> bool:
+    # Same matching rule as BeautifulSoup applies to the 'complaint' lambda:
+    # the class matches if any of its values (or the whole string) matches
+    if node.get('class') is None:
+        return True
+    classes = get_classes(node)
+    return any('complaint' not in c for c in classes) or 'complaint' not in ' '.join(classes)
+
+
+def get_raw_offers(page):
+    return offer_rows_xpath(page)
+
+
+def check_not_found(page) -> bool:
+    not_found = first(not_found_xpath(page))
+    if not_found is not None:
+        return 'Ничего не найдено' in not_found.text_content()
+    return False
+
+
+def get_count_of_offers(page) -> int:
+    if check_not_found(page):
+        return 0
+    title = first(title_xpath(page))
+    if title is None:
+        with open('wrong_bs.pkl', 'w') as f:
+            f.write(lxml.html.tostring(page, encoding='unicode'))
+        logger.warning("Wrong page_bs. Saved as wrong_bs.pkl")
+    assert title is not None
+    count_entry = fix_text(title)
+    match = CianParser.count_re.match(count_entry)
+    if match is None:
+        return 0
+    return int(match.groups()[0])
+
+
+def get_info_columns(offer) -> dict:
+    info = {}
+    for el in offer.iterchildren('td'):
+        classes = get_classes(el)
+        if any(c.startswith('objects_item_info_col_') for c in classes):
+            info[classes[0][-1]] = first(info_w_xpath(el))
+    return info
+
+
+def parse_raw_offer(offer) -> dict:
+    try:
+        info = get_info_columns(offer)
+
+        # col_1 -- расположение
+        entry_info = {'location': {}}
+        loc = first(input_xpath(info['1']))
+        entry_info['location']['coordinates'] = loc.attrib['value']
+        metro = first(metro_xpath(info['1']))
+        metro_link = first(link_xpath(metro))
+        if metro_link is not None:
+            entry_info['location']['metro'] = {}
+            entry_info['location']['metro']['name'] = fix_text(metro_link).replace("м. ", "")
+            metro_descr = fix_text(first(metro_comment_xpath(metro)))
+            entry_info['location']['metro']['description'] = metro_descr
+
+        entry_info['location']['address'] = [fix_text(i) for i in address_xpath(offer)]
+
+        # col_2 -- объект
+        entry_info['object'] = fix_text(info['2'])
+
+        # col_3 -- площадь
+        entry_info['sizes'] = [fix_text(i) for i in td_xpath(info['3'])]
+
+        # col_4 -- цена
+        entry_info['price'] = [fix_text(i) for i in div_xpath(info['4']) if is_price_div(i)]
+
+        # col_5 -- процент
+        entry_info['fee'] = fix_text(info['5'])
+
+        # col_6 -- этаж
+        entry_info['floor'] = fix_text(info['6'])
+
+        # col_7 -- доп. сведения
+        entry_info['info'] = [fix_text(i) for i in td_xpath(info['7'])]
+
+        # col_8 -- контакты
+        if '8' in info:
+            entry_info['contacts'] = fix_text(first(link_xpath(info['8'])))
+
+        # col_9 -- комментарий
+        comment = first(comment_xpath(info['9']))
+        # BeautifulSoup's contents[0]: leading text or the first child element
+        comment_head = comment.text if comment.text is not None else comment[0]
+        entry_info['comment'] = fix_text(comment_head)
+        flat_url = first(href_xpath(comment)).attrib['href']
+        entry_info['url'] = flat_url
+        flat_id = re.match(r".*\/([0-9]*)\/", flat_url).groups()[0]
+        entry_info['id'] = int(flat_id)
+
+        user_link = first(user_link_xpath(info['9']))
+        entry_info['user'] = {}
+        entry_info['user']['name'] = user_link.text_content()
+        user_url = user_link.attrib['href']
+        user_id = re.match(r".*id_user=([0-9]+).*", user_url).groups()[0]
+        entry_info['user']['id'] = int(user_id)
+
+        raw_time = fix_text(first(time_added_xpath(info['9']))).split(",")
+        entry_info['time'] = CianParser.parse_time(raw_time[0], raw_time[1])
+
+        actions = first(actions_xpath(info['9']))
+        photos = fix_text(first(link_xpath(actions)))
+        photos = re.match(r"Фото \(([0-9]+)\)", photos)
+        if photos is not None:
+            photos = int(photos.groups()[0])
+        else:
+            photos = 0
+        entry_info['photos_count'] = photos
+
+        entry_info.update(CianParser.normalize_offer(entry_info))
+        return entry_info
+    except Exception as e:
+        logger.error("There was an exception {}".format(e), exc_info=True)
+        logger.error("Error while parsing offer. Dumping object to file")
+        with open("file_parse_error.html", 'w') as f:
+            f.write(lxml.html.tostring(offer, encoding='unicode'))
@@ -1,17 +1,29 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from typing import Optional, TypedDict, Iterable
+from typing import Optional, TypedDict, Iterable, List
 from urllib.parse import urlparse, parse_qs, urlencode
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
 import logging
+import math
+import threading
 import time
 import config
 import os
 import re
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-from Databases import Databases
+from Parsers import CianLxmlParser
+from Parsers import ParsePool
+from Parsers.MyRequestsCacher import MyRequestsCacher
+from Parsers.DuplicatesIndex import DuplicatesIndex
+from Parsers.OffersWriter import OffersWriter
+from Parsers.PriceSketches import PriceSketches
+from Parsers.Prices import parse_price_rub
+from Parsers.ProxyPool import ProxyPool
+from Parsers.SessionPool import SessionPool
+from Parsers.UrlCheckCache import UrlCheckCache
 from bs4 import BeautifulSoup as bs
 
 import datetime
@@ -19,7 +31,11 @@ import pytz
 
 table_cookies = {'serp_view_mode': 'table'}
 logger = logging.getLogger("CianParser")
-curr_proxy = 0
+proxy_pool = ProxyPool(config.proxies_list)
+# Semaphores limiting simultaneous requests per host and per proxy
+host_limits = {}
+proxy_limits = {}
+limits_lock = threading.Lock()
 
 
 def change_params(url, **kwargs):
@@ -37,6 +53,17 @@ def change_params(url, **kwargs):
     return res + parsed_url.path + '?' + urlencode(qs, doseq=True)
 
 
+def canonicalize_url(url: str) -> str:
+    # Equivalent searches share one key: parameters sorted, paging and time window dropped
+    parsed_url = urlparse(url)
+    qs = parse_qs(parsed_url.query, keep_blank_values=True)
+    qs = sorted((key, sorted(values)) for key, values in qs.items() if key not in ('p', 'totime'))
+    host = (parsed_url.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    return host + parsed_url.path + '?' + urlencode(qs, doseq=True)
+
+
 def get_url_id():
     return datetime.datetime.now().strftime("%c")
 
@@ -79,31 +106,66 @@ def parse_proxies_http(proxy: str):
     return proxies
 
 
-def get_url(url: str, proxy: str = None) -> Optional[bs]:
+def is_captcha(text: str) -> bool:
+    return 'www.google.com/recaptcha' in text
+
+
+def check_response(status_code: int, text: str) -> bool:
+    if config.debug_cian:
+        location = 'url_responses/answer{}.html'.format(get_url_id())
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+        with open(location, 'w') as f:
+            f.write(text)
+    return status_code == 200 and not is_captcha(text)
+
+
+def parse_page(text: str):
+    if config.cian_html_backend == 'lxml':
+        return CianLxmlParser.parse_page(text)
+    return bs(text, 'lxml')
+
+
+def get_limit(limits: dict, key, size: int) -> threading.BoundedSemaphore:
+    with limits_lock:
+        if key not in limits:
+            limits[key] = threading.BoundedSemaphore(size)
+        return limits[key]
+
+
+def fetch_url(url: str, proxy: str = None) -> Optional[str]:
+    text = MyRequestsCacher.get(url)
+    if text is not None or MyRequestsCacher.is_offline():
+        return text
     try:
-        session = requests.Session()
-        # session.cookies.update({"anti_bot": "xxxx"})
-        if proxy:
-            session.proxies = parse_proxies(proxy)
-        retry = Retry(connect=3, backoff_factor=0.5)
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        r = session.get(url, cookies=table_cookies)
-        if config.debug_cian:
-            location = 'url_responses/answer{}.html'.format(get_url_id())
-            os.makedirs(os.path.dirname(location), exist_ok=True)
-            with open(location, 'w') as f:
-                f.write(r.text)
-        if r.status_code != 200 or 'www.google.com/recaptcha' in r.text:
+        session = SessionPool.get_session(proxy)
+        host_limit = get_limit(host_limits, urlparse(url).hostname, config.cian_max_requests_per_host)
+        proxy_limit = get_limit(proxy_limits, proxy, config.cian_max_requests_per_proxy)
+        with host_limit, proxy_limit:
+            start = time.monotonic()
+            r = session.get(url, cookies=table_cookies, timeout=config.cian_request_timeout)
+            latency = time.monotonic() - start
+        if not check_response(r.status_code, r.text):
+            proxy_pool.report_failure(proxy, captcha=is_captcha(r.text))
             return None
-        return bs(r.text, 'lxml')
+        proxy_pool.report_success(proxy, latency)
+        MyRequestsCacher.put(url, r.text)
+        return r.text
     except Exception as e:
+        proxy_pool.report_failure(proxy)
         logger.debug(f'Proxy: {proxy}.\nCian connection error: {e}')
         return None
 
 
+def get_url(url: str, proxy: str = None) -> Optional[bs]:
+    text = fetch_url(url, proxy)
+    if text is None:
+        return None
+    return parse_page(text)
+
+
 def get_raw_offers(bs_res: bs):
+    if CianLxmlParser.is_lxml_node(bs_res):
+        return CianLxmlParser.get_raw_offers(bs_res)
     return bs_res.findAll('tr', {'class': 'offer_container'})
 
 
@@ -162,7 +224,58 @@ def parse_time(date: str, time_str: str) -> datetime:
     return datetime.datetime.combine(date=date, time=parsed_time)
 
 
+number_re = re.compile(r"[0-9]+(?:[.,][0-9]+)?")
+floor_re = re.compile(r"([0-9]+)\s*(?:/|из)\s*([0-9]+)")
+size_labels = (('общ', 'area_total'), ('жил', 'area_living'), ('кух', 'area_kitchen'))
+
+
+def parse_number(text: str) -> Optional[float]:
+    match = number_re.search(text)
+    if match is None:
+        return None
+    return float(match.group().replace(',', '.'))
+
+
+def normalize_offer(offer: dict) -> dict:
+    # Numeric fields parsed from the display strings, stored next to them
+    normalized = {'price_rub': None, 'area_total': None, 'area_living': None,
+                  'area_kitchen': None, 'floor_num': None, 'floors_total': None}
+
+    normalized['price_rub'] = parse_price_rub(offer.get('price'))
+
+    sizes = offer.get('sizes') or []
+    unlabeled = []
+    for size in sizes:
+        value = parse_number(size)
+        if value is None:
+            continue
+        for label, field in size_labels:
+            if label in size.lower():
+                normalized[field] = value
+                break
+        else:
+            unlabeled.append(value)
+    if normalized['area_total'] is None and unlabeled:
+        # Without captions sizes go as total / living / kitchen
+        for (_, field), value in zip(size_labels, unlabeled):
+            if normalized[field] is None:
+                normalized[field] = value
+
+    floor = offer.get('floor') or ''
+    match = floor_re.search(floor)
+    if match is not None:
+        normalized['floor_num'] = int(match.groups()[0])
+        normalized['floors_total'] = int(match.groups()[1])
+    else:
+        value = parse_number(floor)
+        if value is not None:
+            normalized['floor_num'] = int(value)
+    return normalized
+
+
 def parse_raw_offer(offer: bs) -> dict:
+    if CianLxmlParser.is_lxml_node(offer):
+        return CianLxmlParser.parse_raw_offer(offer)
     try:
         info = offer('td', class_=offer_info_class_lambda, recursive=False)
         info = {el['class'][0][-1]: el.find('div', class_='objects_item_info_col_w') for el in info}
@@ -249,6 +362,7 @@ def parse_raw_offer(offer: bs) -> dict:
             photos = 0
         entry_info['photos_count'] = photos
 
+        entry_info.update(normalize_offer(entry_info))
         return entry_info
     except Exception as e:
         logger.error("There was an exception {}".format(e), exc_info=True)
@@ -261,6 +375,8 @@ cian_url = 'cian.ru/cat.php'
 
 
 def check_not_found(page_bs: bs) -> bool:
+    if CianLxmlParser.is_lxml_node(page_bs):
+        return CianLxmlParser.check_not_found(page_bs)
     not_found = page_bs.find("div", attrs={"class": "serps-header_nothing-found__title"})
     if not_found:
         return 'Ничего не найдено' in not_found.text
@@ -268,14 +384,26 @@ def check_not_found(page_bs: bs) -> bool:
 
 
 def check_url_correct(url: str) -> bool:
+    key = canonicalize_url(url)
+    cached = UrlCheckCache.get(key)
+    if cached is not None:
+        logger.debug("Check result for {} is cached".format(key))
+        return cached
     if cian_url not in url:
+        UrlCheckCache.put(key, False)
         return False
+    if config.cian_async_engine:
+        from Parsers import AsyncCianParser
+        return AsyncCianParser.check_url_correct_sync(url)
     try:
         page_bs = safe_request(change_params(url, totime=3000, p=1))
         raw_offers = get_raw_offers(page_bs)
-        return bool(len(raw_offers))
     except Exception:
+        # Network failures say nothing about the URL, so they are not cached
         return False
+    result = bool(len(raw_offers))
+    UrlCheckCache.put(key, result)
+    return result
 
 
 class Offer(TypedDict):
@@ -284,30 +412,57 @@ class Offer(TypedDict):
     seen_by_suspicious_validator: bool
 
 
-def get_new_offers(url, time=config.cian_default_timeout):
+def get_new_offers(url, time=config.cian_default_timeout, incremental=False):
+    # Database modules connect on import, so parsing stays usable offline
+    from Databases import Databases
+    from Databases.CrawlWatermarks import CrawlWatermarksDB
     db = Databases.get_flats_db()
+    duplicates = DuplicatesIndex(Databases.get_duplicate_buckets_db(), Databases.get_duplicate_clusters_db())
+    price_sketches = PriceSketches(Databases.get_price_sketches_db())
     ids = {}
-    for offer in get_offers(url, time):
-        if offer is None:
-            continue
-        if offer['id'] in ids.keys():
-            old = ids[offer['id']]
-            old = old.copy()
-            if old != offer:
-                logger.error("Different dicts: {}\n{}".format(offer, old))
-        else:
-            offer['seen_by_suspicious_validator'] = False
-            offer['suspicious'] = False
-            ids[offer['id']] = offer
-            db.find_one_and_replace({'id': offer['id']}, offer, upsert=True)
-            yield offer
+    known_ids = None
+    if incremental:
+        watermark_url = canonicalize_url(url)
+        known_ids = CrawlWatermarksDB.get_known_ids(watermark_url)
+    writer = OffersWriter(db, duplicates, price_sketches)
+    try:
+        for offer in get_offers(url, time, known_ids):
+            if offer is None:
+                continue
+            if offer['id'] in ids.keys():
+                old = ids[offer['id']]
+                old = old.copy()
+                # Set by the writer, not by the parser
+                old.pop('fingerprint', None)
+                old.pop('duplicate_cluster', None)
+                if old != offer:
+                    logger.error("Different dicts: {}\n{}".format(offer, old))
+            else:
+                offer['seen_by_suspicious_validator'] = False
+                offer['suspicious'] = False
+                ids[offer['id']] = offer
+                yield from writer.add(offer)
+        yield from writer.flush()
+    finally:
+        # Buffered offers are stored even if the consumer stops early
+        writer.flush()
+        logger.debug("Offers writer stats: {}".format(writer.get_stats()))
+        logger.debug("Duplicates index stats: {}".format(duplicates.get_stats()))
+        logger.debug("Price sketches stats: {}".format(price_sketches.get_stats()))
     logger.info("Totally parsed {} real offers.".format(len(ids)))
+    if incremental and ids:
+        last_offer_time = max(offer['time'] for offer in ids.values())
+        CrawlWatermarksDB.update(watermark_url, ids.keys(), last_offer_time)
+
+
+count_re = re.compile(r".*?([1-9][0-9]*)\s*объявлен")
 
 
 def get_count_of_offers(page_bs: bs) -> int:
+    if CianLxmlParser.is_lxml_node(page_bs):
+        return CianLxmlParser.get_count_of_offers(page_bs)
     if check_not_found(page_bs):
         return 0
-    count_re = re.compile(r".*?([1-9][0-9]*)\s*объявлен")
     count_entry = fix_text(page_bs.find("title"))
     if count_entry is None:
         with open('wrong_bs.pkl', 'w') as f:
@@ -321,31 +476,61 @@ def get_count_of_offers(page_bs: bs) -> int:
     return int(count)
 
 
-def safe_request(url) -> Optional[bs]:
-    global curr_proxy
-    trials = 0
-    proxies_num = len(config.proxies_list)
-    page_bs = get_url(url)
-    if page_bs is not None:
-        logger.debug(f"Request was successful! (no proxy)")
-        return page_bs
-    logger.warning("Request wasn't successful! (no proxy)")
-    time.sleep(1)
-    while proxies_num and trials < config.cian_trials_before_none:
-        tmp_proxy = (curr_proxy - 1) % proxies_num
-        while curr_proxy != tmp_proxy:
-            page_bs = get_url(url, config.proxies_list[curr_proxy])
-            if page_bs is not None:
-                logger.debug(f"Request was successful! Proxy: {config.proxies_list[curr_proxy]}")
-                return page_bs
-            logger.warning(f"Request wasn't successful! #{curr_proxy}")
-            time.sleep(1)
-            curr_proxy = (curr_proxy + 1) % proxies_num
-        trials += 1
+def safe_fetch(url) -> str:
+    for _ in range(config.cian_trials_before_none):
+        candidates = proxy_pool.get_candidates()
+        if not candidates:
+            wait_time = min(proxy_pool.time_until_available(), config.cian_proxy_max_wait)
+            logger.warning("All proxies are cooling down. Waiting {:.1f} seconds".format(wait_time))
+            time.sleep(wait_time)
+            continue
+        for proxy in candidates:
+            text = fetch_url(url, proxy)
+            if text is not None:
+                logger.debug(f"Request was successful! Proxy: {proxy or 'no proxy'}")
+                return text
+            logger.warning(f"Request wasn't successful! Proxy: {proxy or 'no proxy'}")
     raise Exception("Total request didn't succeed :<")
 
 
-def get_offers(raw_url: str, url_time: int) -> Iterable[Offer]:
+def safe_request(url) -> Optional[bs]:
+    return parse_page(safe_fetch(url))
+
+
+def fetch_pages(urls: Iterable[str]) -> Iterable[str]:
+    # Yields raw pages in the order of urls. With cian_pages_concurrency > 1
+    # up to that many next pages are fetched ahead in a thread pool.
+    concurrency = config.cian_pages_concurrency
+    if concurrency <= 1:
+        for url in urls:
+            yield safe_fetch(url)
+        return
+    urls = iter(urls)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="CianPage") as executor:
+        futures = deque(executor.submit(safe_fetch, url) for url in islice(urls, concurrency))
+        try:
+            while futures:
+                text = futures.popleft().result()
+                futures.extend(executor.submit(safe_fetch, url) for url in islice(urls, 1))
+                yield text
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def is_known_page(offers: List[Offer], known_ids: Optional[set]) -> bool:
+    if not known_ids:
+        return False
+    offers = [offer for offer in offers if offer is not None]
+    return len(offers) > 0 and all(offer['id'] in known_ids for offer in offers)
+
+
+def get_offers(raw_url: str, url_time: int, known_ids: Optional[set] = None) -> Iterable[Offer]:
+    # With known_ids pagination stops at the first page made only of known offers
+    if config.cian_async_engine:
+        from Parsers import AsyncCianParser
+        yield from AsyncCianParser.get_offers_sync(raw_url, url_time, known_ids)
+        return
     url = change_params(raw_url, totime=url_time, p=1)
     page_bs = safe_request(url)
     # Получаем число предложений
@@ -355,16 +540,35 @@ def get_offers(raw_url: str, url_time: int) -> Iterable[Offer]:
     if num_of_offers == 0:
         return
     raw_offers = get_raw_offers(page_bs)
-    yield from (parse_raw_offer(offer) for offer in raw_offers)
-    num_of_offers -= len(raw_offers)
-    i = 2
-    while num_of_offers > 0:
-        url = change_params(raw_url, totime=url_time, p=i)
-        raw_offers = get_raw_offers(safe_request(url))
+    if len(raw_offers) > 0:
+        # A search that has offers is a valid one for the link checks
+        UrlCheckCache.put(canonicalize_url(raw_url), True)
+    offers = [parse_raw_offer(offer) for offer in raw_offers]
+    pages_num = 1
+    if len(raw_offers) > 0:
+        pages_num += math.ceil(max(num_of_offers - len(raw_offers), 0) / len(raw_offers))
+    if is_known_page(offers, known_ids):
+        logger.info("Page 1 is already known. Fetched 1 of {} pages".format(pages_num))
+        return
+    yield from offers
+    urls = (change_params(raw_url, totime=url_time, p=i) for i in range(2, pages_num + 1))
+    if known_ids:
+        # Incremental crawls usually stop after a page or two, so nothing is
+        # read ahead: a page is fetched only once the previous one had new offers
+        pages = (ParsePool.parse_page_offers(safe_fetch(url)) for url in urls)
+    else:
+        # Network I/O and HTML parsing overlap: pages are parsed (possibly in
+        # worker processes) while the next ones are being fetched
+        pages = ParsePool.parse_pages(fetch_pages(urls))
+    for i, offers in enumerate(pages, start=2):
         logger.debug("Parsing {} page".format(i))
-        yield from (parse_raw_offer(offer) for offer in raw_offers)
-        num_of_offers -= len(raw_offers)
-        i += 1
+        if is_known_page(offers, known_ids):
+            logger.info("Page {} is already known. Fetched {} of {} pages".format(i, i, pages_num))
+            return
+        yield from offers
+    logger.debug("Session pool stats: {}".format(SessionPool.get_stats()))
+    logger.debug("Proxy pool stats: {}".format(proxy_pool.get_stats()))
+    logger.debug("Responses cache stats: {}".format(MyRequestsCacher.get_stats()))
 
 
 if __name__ == "__main__":
@@ -375,6 +579,7 @@ if __name__ == "__main__":
     parser.add_argument('-t', '--time', type=int, help='Set time of last parsing',
                         default=360000000000000000000)
     args = parser.parse_args()
+    from Databases import Databases
     db = Databases.get_flats_db()
     for info, info_id in get_offers(args.url, args.time):
         write_to_database(info_id, info, db)
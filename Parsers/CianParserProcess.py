@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
 from typing import TypedDict, Callable, Optional
 
 import LoggerInit
 import config
 from Parsers import CianParser
+from Parsers.MyRequestsCacher import MyRequestsCacher
 from Queues import QueueWrapper
 from Queues.ProducerConsumer.ProducerFactory import ProducerFactory
 
@@ -17,6 +19,7 @@ class CheckUrlMessage(TypedDict):
 class ParseUrlMessage(TypedDict):
     url: str
     time: Optional[int]
+    incremental: Optional[bool]
 
 
 def check_url_callback(message: CheckUrlMessage, answer_callback: Callable[[any], None]) -> bool:
@@ -24,16 +27,19 @@ def check_url_callback(message: CheckUrlMessage, answer_callback: Callable[[any]
     logger.info("Checking url: {}".format(url))
     result = CianParser.check_url_correct(url)
     answer_callback(result)
+    logger.debug("Check requests wait stats: {}".format(
+        ProducerFactory.get_wait_stats().get(config.check_url_req_queue)))
     return True
 
 
 def parse_url_callback(message: ParseUrlMessage, answer_callback: Callable[[any], None]) -> bool:
     url = message['url']
+    incremental = message.get('incremental', False)
     if 'time' in message.keys():
         time = message['time']
-        result = CianParser.get_new_offers(url, time)
+        result = CianParser.get_new_offers(url, time, incremental=incremental)
     else:
-        result = CianParser.get_new_offers(url)
+        result = CianParser.get_new_offers(url, incremental=incremental)
     result = [offer['id'] for offer in result]
     answer_callback(result)
     return True
@@ -42,13 +48,32 @@ def parse_url_callback(message: ParseUrlMessage, answer_callback: Callable[[any]
 @LoggerInit.catch_exceptions
 def main():
     QueueWrapper.init()
+    logger.info("Responses cache mode: {}".format(MyRequestsCacher.get_mode()))
+    MyRequestsCacher.purge_expired()
+    # Users wait in the bot for link checks, so checks get their own
+    # workers and never queue up behind crawls. Crawls never run in the
+    # consuming thread either: they would hold up check deliveries.
+    if config.parser_workers < 1:
+        raise ValueError("parser_workers must be at least 1, got {}".format(config.parser_workers))
+    logger.info("Handling requests in {} workers".format(config.parser_workers))
+    executor = ThreadPoolExecutor(max_workers=config.parser_workers, thread_name_prefix="ParserWorker")
+    check_executor = ThreadPoolExecutor(max_workers=config.parser_check_workers, thread_name_prefix="CheckWorker")
+    prefetch = config.parser_prefetch
     ProducerFactory.subscribe_producer(config.check_url_req_queue, config.check_url_ans_queue,
-                                       check_url_callback)
+                                       check_url_callback, check_executor,
+                                       prefetch.get(config.check_url_req_queue),
+                                       latency_target=config.check_url_latency_target)
     ProducerFactory.subscribe_producer(config.parse_url_req_queue, config.parse_url_ans_queue,
-                                       parse_url_callback)
+                                       parse_url_callback, executor,
+                                       prefetch.get(config.parse_url_req_queue))
     ProducerFactory.subscribe_producer(config.parse_all_moscow_req_queue, config.parse_all_moscow_ans_queue,
-                                       parse_url_callback)
+                                       parse_url_callback, executor,
+                                       prefetch.get(config.parse_all_moscow_req_queue))
     try:
         QueueWrapper.start(detach=False)
     except KeyboardInterrupt:
         QueueWrapper.close()
+    finally:
+        logger.info("Requests wait stats: {}".format(ProducerFactory.get_wait_stats()))
+        check_executor.shutdown(wait=False)
+        executor.shutdown(wait=False)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Near-duplicate detection of offers reposted by several agents.
+# An offer is turned into shingles (word 3-grams of the comment plus
+# normalized address, metro, price, area and floor tokens), the shingles
+# into a MinHash signature and the signature into LSH bands. Offers sharing
+# a band bucket and close enough by the estimated Jaccard similarity get
+# the same duplicate cluster id: the id of the first offer of the cluster.
+import hashlib
+import logging
+import math
+import random
+import re
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from pymongo import UpdateOne
+
+import config
+
+logger = logging.getLogger("DuplicatesIndex")
+
+word_re = re.compile(r"\w+")
+mersenne_prime = (1 << 61) - 1
+max_hash = (1 << 61) - 1
+
+
+def get_hash_params(num_perm: int) -> List[tuple]:
+    # Fixed seed: signatures have to be comparable between processes and restarts
+    rnd = random.Random(1104)
+    return [(rnd.randrange(1, mersenne_prime), rnd.randrange(0, mersenne_prime)) for _ in range(num_perm)]
+
+
+hash_params = get_hash_params(config.duplicates_num_perm)
+
+
+def get_words(text: str) -> List[str]:
+    return word_re.findall(text.lower())
+
+
+def get_shingles(offer: dict) -> Set[str]:
+    shingles = set()
+    words = get_words(offer.get('comment') or '')
+    size = config.duplicates_shingle_size
+    for i in range(max(len(words) - size + 1, 1 if words else 0)):
+        shingles.add('c:' + ' '.join(words[i:i + size]))
+
+    location = offer.get('location') or {}
+    for word in get_words(' '.join(location.get('address') or [])):
+        shingles.add('a:' + word)
+    metro = location.get('metro')
+    if metro:
+        shingles.add('m:' + ' '.join(get_words(metro.get('name', ''))))
+    if offer.get('price_rub'):
+        # Log buckets, so small discounts of a reposted flat still match
+        shingles.add('p:{}'.format(int(math.log(offer['price_rub'], 1 + config.duplicates_price_step))))
+    if offer.get('area_total'):
+        shingles.add('s:{}'.format(int(round(offer['area_total']))))
+    if offer.get('floor_num') is not None:
+        shingles.add('f:{}/{}'.format(offer['floor_num'], offer.get('floors_total')))
+    return shingles
+
+
+def hash_shingle(shingle: str) -> int:
+    return int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def get_signature(shingles: Set[str]) -> List[int]:
+    hashes = [hash_shingle(shingle) for shingle in shingles]
+    if not hashes:
+        return [max_hash] * len(hash_params)
+    return [min((a * h + b) % mersenne_prime for h in hashes) for a, b in hash_params]
+
+
+def get_bands(signature: List[int]) -> List[str]:
+    rows = len(signature) // config.duplicates_bands
+    bands = []
+    for band in range(config.duplicates_bands):
+        chunk = signature[band * rows:(band + 1) * rows]
+        digest = hashlib.sha1(','.join(map(str, chunk)).encode('ascii')).hexdigest()
+        bands.append('{}:{}'.format(band, digest))
+    return bands
+
+
+def get_similarity(first: List[int], second: List[int]) -> float:
+    return sum(1 for a, b in zip(first, second) if a == b) / len(first)
+
+
+class DuplicatesIndex:
+    # LSH buckets and clusters live in Mongo, one document per band bucket and
+    # one per cluster, so a signature is stored once:
+    # buckets: {'band': <BAND KEY>, 'cluster': <CLUSTER ID>, 'updated': <datetime>}
+    # clusters: {'cluster': <CLUSTER ID>, 'signature': <signature of the first offer>, 'updated': <datetime>}
+    # Both expire by TTL indexes on 'updated'. A cluster is touched whenever an
+    # offer joins it, so it outlives the buckets pointing to it.
+    # A batch of offers costs two finds and two bulk_writes.
+    def __init__(self, db, clusters_db):
+        self.db = db
+        self.clusters_db = clusters_db
+        self.clustered = 0
+        self.duplicates = 0
+
+    def find_cluster(self, signature: List[int], bands: List[str], buckets: Dict[str, int],
+                     signatures: Dict[int, List[int]]) -> Optional[int]:
+        best, best_similarity = None, config.duplicates_threshold
+        for band in bands:
+            cluster = buckets.get(band)
+            if cluster is None or cluster not in signatures:
+                continue
+            similarity = get_similarity(signature, signatures[cluster])
+            if similarity >= best_similarity:
+                best, best_similarity = cluster, similarity
+        return best
+
+    def assign_clusters(self, offers: List[dict]):
+        # Sets offer['duplicate_cluster'] for every offer of the batch
+        if not offers:
+            return
+        prepared = []
+        for offer in offers:
+            signature = get_signature(get_shingles(offer))
+            prepared.append((offer, signature, get_bands(signature)))
+        all_bands = list({band for _, _, bands in prepared for band in bands})
+        buckets = {bucket['band']: bucket['cluster']
+                   for bucket in self.db.find({'band': {'$in': all_bands}}, {'band': 1, 'cluster': 1})}
+        signatures = {cluster['cluster']: cluster['signature']
+                      for cluster in self.clusters_db.find({'cluster': {'$in': list(set(buckets.values()))}},
+                                                           {'cluster': 1, 'signature': 1})}
+
+        now = datetime.utcnow()
+        # <BAND KEY>: True for new buckets, False for the existing ones of the chosen clusters
+        touched_bands = {}
+        # <CLUSTER ID>: signature for new clusters, None for the existing ones
+        touched = {}
+        for offer, signature, bands in prepared:
+            cluster = self.find_cluster(signature, bands, buckets, signatures)
+            if cluster is None:
+                cluster = offer['id']
+                # Later offers of this batch see the clusters of the earlier ones
+                signatures[cluster] = signature
+                touched[cluster] = signature
+            else:
+                if cluster != offer['id']:
+                    self.duplicates += 1
+                touched.setdefault(cluster, None)
+            offer['duplicate_cluster'] = cluster
+            self.clustered += 1
+            for band in bands:
+                if band not in buckets:
+                    buckets[band] = cluster
+                    touched_bands[band] = True
+                elif buckets[band] == cluster:
+                    # Buckets leading to live clusters don't expire
+                    touched_bands.setdefault(band, False)
+        requests = []
+        for band, new in touched_bands.items():
+            if new:
+                requests.append(UpdateOne({'band': band},
+                                          {'$setOnInsert': {'cluster': buckets[band]}, '$set': {'updated': now}},
+                                          upsert=True))
+            else:
+                requests.append(UpdateOne({'band': band}, {'$set': {'updated': now}}))
+        cluster_requests = []
+        for cluster, signature in touched.items():
+            update = {'$set': {'updated': now}}
+            if signature is not None:
+                update['$setOnInsert'] = {'signature': signature}
+            cluster_requests.append(UpdateOne({'cluster': cluster}, update, upsert=signature is not None))
+        # Clusters first: a bucket never points to a cluster without a signature
+        if cluster_requests:
+            self.clusters_db.bulk_write(cluster_requests, ordered=False)
+        if requests:
+            self.db.bulk_write(requests, ordered=False)
+
+    def get_stats(self) -> dict:
+        return {'clustered': self.clustered, 'duplicates': self.duplicates}
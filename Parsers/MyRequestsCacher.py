@@ -1,3 +1,196 @@
 # -*- coding: utf-8 -*-
-import requests_cache
-requests_cache.install_cache('.cache')
+# Record/replay layer of the CIAN fetchers. Modes (config.cian_http_cache_mode):
+#   'off'    -- every page goes to the network
+#   'record' -- pages are fetched and stored on disk for cian_http_cache_ttl
+#   'replay' -- pages are served from disk only, misses fail without network
+#   'dedup'  -- stored pages younger than cian_http_dedup_ttl are served,
+#               so identical fetches of different crawls hit CIAN once
+# Recordings (record/replay) live in <dir>/records, dedup pages in <dir>/dedup,
+# so the short dedup TTL never touches recordings. In a store bodies are
+# gzipped and content-addressed: bodies/<sha1 of body>.gz, and
+# index/<sha1 of url>.json points a request to its body.
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+import config
+
+logger = logging.getLogger("MyRequestsCacher")
+
+modes = ('off', 'record', 'replay', 'dedup')
+
+
+def get_request_key(url: str) -> str:
+    # Query parameters are sorted, so the same page is found whatever order the link had
+    parsed_url = urlparse(url)
+    query = urlencode(sorted(parse_qsl(parsed_url.query, keep_blank_values=True)))
+    host = (parsed_url.hostname or '').lower()
+    return hashlib.sha1((host + parsed_url.path + '?' + query).encode('utf-8')).hexdigest()
+
+
+def write_atomic(path: str, data: bytes):
+    # Readers in other parser processes never see half written files
+    tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class MyRequestsCacher:
+    hits = 0
+    misses = 0
+    stored = 0
+    lock = threading.Lock()
+    purge_lock = threading.Lock()
+    last_purge = 0.0
+
+    @staticmethod
+    def get_mode() -> str:
+        mode = config.cian_http_cache_mode
+        if mode not in modes:
+            raise ValueError("Unknown cian_http_cache_mode {}".format(mode))
+        return mode
+
+    @staticmethod
+    def is_offline() -> bool:
+        return MyRequestsCacher.get_mode() == 'replay'
+
+    @staticmethod
+    def get_ttl() -> Optional[float]:
+        mode = MyRequestsCacher.get_mode()
+        if mode == 'dedup':
+            return config.cian_http_dedup_ttl
+        if mode == 'replay':
+            # Recordings are replayed whatever their age
+            return None
+        return config.cian_http_cache_ttl
+
+    @staticmethod
+    def get_store_dir() -> str:
+        store = 'dedup' if MyRequestsCacher.get_mode() == 'dedup' else 'records'
+        return os.path.join(config.cian_http_cache_dir, store)
+
+    @staticmethod
+    def get_index_path(key: str) -> str:
+        return os.path.join(MyRequestsCacher.get_store_dir(), 'index', key + '.json')
+
+    @staticmethod
+    def get_body_path(digest: str) -> str:
+        return os.path.join(MyRequestsCacher.get_store_dir(), 'bodies', digest + '.gz')
+
+    @staticmethod
+    def count(name: str):
+        with MyRequestsCacher.lock:
+            setattr(MyRequestsCacher, name, getattr(MyRequestsCacher, name) + 1)
+
+    @staticmethod
+    def get(url: str) -> Optional[str]:
+        # Stored page text or None. Record mode never serves, it only writes.
+        mode = MyRequestsCacher.get_mode()
+        if mode in ('off', 'record'):
+            return None
+        key = get_request_key(url)
+        try:
+            with open(MyRequestsCacher.get_index_path(key)) as f:
+                entry = json.load(f)
+            ttl = MyRequestsCacher.get_ttl()
+            if ttl is not None and time.time() - entry['time'] > ttl:
+                MyRequestsCacher.count('misses')
+                return None
+            with gzip.open(MyRequestsCacher.get_body_path(entry['body']), 'rt', encoding='utf-8') as f:
+                text = f.read()
+        except (OSError, ValueError, KeyError):
+            MyRequestsCacher.count('misses')
+            if mode == 'replay':
+                logger.warning("No recorded response for {}".format(url))
+            return None
+        MyRequestsCacher.count('hits')
+        return text
+
+    @staticmethod
+    def put(url: str, text: str):
+        # Only valid pages are passed here, captchas and errors are never stored
+        if MyRequestsCacher.get_mode() not in ('record', 'dedup'):
+            return
+        data = text.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        store_dir = MyRequestsCacher.get_store_dir()
+        try:
+            os.makedirs(os.path.join(store_dir, 'index'), exist_ok=True)
+            os.makedirs(os.path.join(store_dir, 'bodies'), exist_ok=True)
+            body_path = MyRequestsCacher.get_body_path(digest)
+            if not os.path.exists(body_path):
+                write_atomic(body_path, gzip.compress(data))
+            entry = {'url': url, 'body': digest, 'time': time.time()}
+            write_atomic(MyRequestsCacher.get_index_path(get_request_key(url)),
+                         json.dumps(entry).encode('utf-8'))
+        except OSError as e:
+            logger.error("Couldn't store response for {}: {}".format(url, e))
+            return
+        MyRequestsCacher.count('stored')
+        MyRequestsCacher.purge_if_needed()
+
+    @staticmethod
+    def purge_if_needed():
+        # Every fetched page adds a body, so dedup pages are purged as the parser runs
+        if MyRequestsCacher.get_mode() != 'dedup' \
+                or time.monotonic() - MyRequestsCacher.last_purge < config.cian_http_dedup_purge_interval:
+            return
+        if not MyRequestsCacher.purge_lock.acquire(blocking=False):
+            return
+        try:
+            MyRequestsCacher.purge_expired()
+        finally:
+            MyRequestsCacher.purge_lock.release()
+
+    @staticmethod
+    def purge_expired() -> int:
+        # Drops expired index entries of the current mode's store and the
+        # bodies nobody points to anymore
+        MyRequestsCacher.last_purge = time.monotonic()
+        ttl = MyRequestsCacher.get_ttl()
+        store_dir = MyRequestsCacher.get_store_dir()
+        index_dir = os.path.join(store_dir, 'index')
+        bodies_dir = os.path.join(store_dir, 'bodies')
+        if ttl is None or not os.path.isdir(index_dir):
+            return 0
+        now = time.time()
+        alive = set()
+        removed = 0
+        for name in os.listdir(index_dir):
+            path = os.path.join(index_dir, name)
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+                if now - entry['time'] <= ttl:
+                    alive.add(entry['body'] + '.gz')
+                    continue
+                os.remove(path)
+                removed += 1
+            except (OSError, ValueError, KeyError):
+                continue
+        if os.path.isdir(bodies_dir):
+            for name in os.listdir(bodies_dir):
+                if name.endswith('.gz') and name not in alive:
+                    try:
+                        os.remove(os.path.join(bodies_dir, name))
+                    except OSError:
+                        pass
+        logger.info("Purged {} expired responses".format(removed))
+        return removed
+
+    @staticmethod
+    def get_stats() -> dict:
+        with MyRequestsCacher.lock:
+            return {
+                'mode': config.cian_http_cache_mode,
+                'hits': MyRequestsCacher.hits,
+                'misses': MyRequestsCacher.misses,
+                'stored': MyRequestsCacher.stored,
+            }
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import time
+from datetime import datetime
+from typing import List
+
+from pymongo import UpdateOne
+
+import config
+from Parsers.Prices import get_price_rub
+
+logger = logging.getLogger("OffersWriter")
+
+# Not part of the offer content: validator state and our own bookkeeping
+fingerprint_ignored_fields = ('_id', 'fingerprint', 'price_history', 'duplicate_cluster',
+                              'seen_by_suspicious_validator', 'suspicious')
+# Fields parse_raw_offer may omit; removed from the stored flat when missing
+optional_fields = ('contacts',)
+
+
+def get_fingerprint(offer: dict) -> str:
+    content = {key: value for key, value in offer.items() if key not in fingerprint_ignored_fields}
+    dump = json.dumps(content, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(dump.encode('utf-8')).hexdigest()
+
+
+class OffersWriter:
+    # Buffers parsed offers and upserts them with one unordered bulk_write
+    # per cian_bulk_write_size offers or cian_bulk_write_interval seconds.
+    # Offers whose fingerprint matches the stored one are not rewritten,
+    # price changes are appended to the flat's price_history.
+    # With a DuplicatesIndex the written offers get their duplicate_cluster,
+    # with PriceSketches they are checked for suspicious prices.
+    def __init__(self, db, duplicates=None, price_sketches=None):
+        self.db = db
+        self.duplicates = duplicates
+        self.price_sketches = price_sketches
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.written = 0
+        self.unchanged = 0
+        self.price_changes = 0
+        self.batches = 0
+        self.write_time = 0.0
+        self.max_write_time = 0.0
+
+    def add(self, offer: dict) -> List[dict]:
+        # Returns the offers that were stored by this call
+        self.buffer.append(offer)
+        if len(self.buffer) >= config.cian_bulk_write_size \
+                or time.monotonic() - self.last_flush >= config.cian_bulk_write_interval:
+            return self.flush()
+        return []
+
+    def get_requests(self, offers: List[dict]) -> List[UpdateOne]:
+        stored = self.db.find({'id': {'$in': [offer['id'] for offer in offers]}},
+                              {'id': 1, 'fingerprint': 1, 'price': 1, 'price_rub': 1, 'duplicate_cluster': 1})
+        stored = {flat['id']: flat for flat in stored}
+        now = datetime.utcnow()
+        changed = []
+        for offer in offers:
+            offer['fingerprint'] = get_fingerprint(offer)
+            flat = stored.get(offer['id'])
+            if flat is not None and flat.get('fingerprint') == offer['fingerprint'] \
+                    and (self.duplicates is None or 'duplicate_cluster' in flat):
+                if 'duplicate_cluster' in flat:
+                    offer['duplicate_cluster'] = flat['duplicate_cluster']
+                self.unchanged += 1
+                continue
+            changed.append(offer)
+        if self.duplicates is not None:
+            self.duplicates.assign_clusters(changed)
+        if self.price_sketches is not None:
+            # Only prices of new flats go to the sketches, rewritten flats are already counted
+            self.price_sketches.classify(changed, [offer['id'] for offer in changed if offer['id'] not in stored])
+        requests = []
+        for offer in changed:
+            flat = stored.get(offer['id'])
+            update = {'$set': offer}
+            missing = {field: '' for field in optional_fields if field not in offer}
+            if missing:
+                update['$unset'] = missing
+            price = get_price_rub(offer)
+            if flat is None or get_price_rub(flat) != price:
+                if flat is not None:
+                    self.price_changes += 1
+                update['$push'] = {'price_history': {'time': now, 'price': price}}
+            requests.append(UpdateOne({'id': offer['id']}, update, upsert=True))
+        return requests
+
+    def flush(self) -> List[dict]:
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return []
+        offers, self.buffer = self.buffer, []
+        start = time.monotonic()
+        requests = self.get_requests(offers)
+        if requests:
+            self.db.bulk_write(requests, ordered=False)
+        latency = time.monotonic() - start
+        self.written += len(requests)
+        self.batches += 1
+        self.write_time += latency
+        self.max_write_time = max(self.max_write_time, latency)
+        logger.debug("Wrote {} of {} offers in {:.3f} seconds".format(len(requests), len(offers), latency))
+        return offers
+
+    def get_stats(self) -> dict:
+        return {
+            'written': self.written,
+            'unchanged': self.unchanged,
+            'price_changes': self.price_changes,
+            'batches': self.batches,
+            'avg_write_time': self.write_time / self.batches if self.batches else 0.0,
+            'max_write_time': self.max_write_time,
+        }
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import logging
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Iterable, List, Optional
+
+import config
+from Parsers import CianParser
+
+logger = logging.getLogger("ParsePool")
+
+
+class ParsePool:
+    # Process-wide pool of HTML parsing workers, created on first use
+    executor: Optional[ProcessPoolExecutor] = None
+    lock = threading.Lock()
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return config.cian_parse_workers > 0
+
+    @staticmethod
+    def get_executor() -> ProcessPoolExecutor:
+        with ParsePool.lock:
+            if ParsePool.executor is None:
+                logger.info("Starting {} parse workers".format(config.cian_parse_workers))
+                # The pool is created from worker threads, a forked child could
+                # inherit locks held by other threads (logging, SessionPool).
+                # Forkserver children start from a clean single-threaded process.
+                ParsePool.executor = ProcessPoolExecutor(max_workers=config.cian_parse_workers,
+                                                         mp_context=multiprocessing.get_context('forkserver'))
+            return ParsePool.executor
+
+    @staticmethod
+    def shutdown():
+        with ParsePool.lock:
+            if ParsePool.executor is not None:
+                ParsePool.executor.shutdown()
+                ParsePool.executor = None
+
+
+def parse_page_offers(text: str) -> List[dict]:
+    # Runs inside the worker processes, so it gets raw HTML and returns plain dicts
+    page = CianParser.parse_page(text)
+    return [CianParser.parse_raw_offer(offer) for offer in CianParser.get_raw_offers(page)]
+
+
+def parse_pages(texts: Iterable[str]) -> Iterable[List[dict]]:
+    # Yields parsed offers page by page in the order of texts. At most
+    # cian_parse_max_inflight_pages pages are waiting in the pool, so the
+    # fetching side is not drained faster than pages get parsed.
+    if not ParsePool.is_enabled():
+        for text in texts:
+            yield parse_page_offers(text)
+        return
+    executor = ParsePool.get_executor()
+    texts = iter(texts)
+    futures = deque(executor.submit(parse_page_offers, text)
+                    for text in islice(texts, config.cian_parse_max_inflight_pages))
+    try:
+        while futures:
+            offers = futures.popleft().result()
+            futures.extend(executor.submit(parse_page_offers, text) for text in islice(texts, 1))
+            yield offers
+    finally:
+        for future in futures:
+            future.cancel()
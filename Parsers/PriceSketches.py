@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Per-station price distributions for classifying new offers as suspicious
+# at ingest time. A sketch keeps counts of prices in logarithmic buckets
+# (as DDSketch does): bucket i holds prices in (gamma^(i-1), gamma^i], so any
+# quantile is known up to price_sketch_accuracy relative error, and a
+# station needs a few hundred buckets at most whatever the number of flats.
+# Entry: {'station': <lowercased name>, 'count': <int>, 'buckets': {'<i>': <int>}}
+import logging
+import math
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+
+from pymongo import ReplaceOne, UpdateOne
+
+import config
+
+logger = logging.getLogger("PriceSketches")
+
+gamma = (1 + config.price_sketch_accuracy) / (1 - config.price_sketch_accuracy)
+log_gamma = math.log(gamma)
+
+
+def get_bucket(price: int) -> int:
+    return math.ceil(math.log(price) / log_gamma)
+
+
+def get_station(offer: dict) -> Optional[str]:
+    metro = (offer.get('location') or {}).get('metro')
+    if not metro or not metro.get('name'):
+        return None
+    return metro['name'].lower()
+
+
+def count_below(sketch: dict, bucket: int) -> int:
+    return sum(count for key, count in sketch['buckets'].items() if int(key) < bucket)
+
+
+def is_suspicious(sketch: Optional[dict], price: int) -> Optional[bool]:
+    # True for the cheapest suspicious_fraction of the station, None while
+    # the station has too few flats to tell (left to the weekly check)
+    if sketch is None or sketch['count'] < config.price_sketch_min_count:
+        return None
+    return count_below(sketch, get_bucket(price)) < sketch['count'] * config.suspicious_fraction
+
+
+class PriceSketches:
+    def __init__(self, db):
+        self.db = db
+        self.classified = 0
+        self.suspicious = 0
+
+    def get_sketches(self, stations: Iterable[str]) -> Dict[str, dict]:
+        return {sketch['station']: sketch for sketch in self.db.find({'station': {'$in': list(stations)}})}
+
+    def classify(self, offers: List[dict], new_ids: Iterable[int] = ()):
+        # Sets suspicious and seen_by_suspicious_validator of the offers the
+        # sketches can decide on. Prices of offers in new_ids are added to the
+        # sketches afterwards: one find and one bulk_write per batch.
+        new_ids = set(new_ids)
+        priced = [(offer, get_station(offer)) for offer in offers if offer.get('price_rub')]
+        priced = [(offer, station) for offer, station in priced if station is not None]
+        if not priced:
+            return
+        sketches = self.get_sketches({station for _, station in priced})
+        increments = defaultdict(lambda: defaultdict(int))
+        for offer, station in priced:
+            suspicious = is_suspicious(sketches.get(station), offer['price_rub'])
+            if suspicious is not None:
+                offer['suspicious'] = suspicious
+                offer['seen_by_suspicious_validator'] = True
+                self.classified += 1
+                self.suspicious += suspicious
+            if offer['id'] in new_ids:
+                increments[station][str(get_bucket(offer['price_rub']))] += 1
+        requests = []
+        for station, buckets in increments.items():
+            inc = {'buckets.' + key: count for key, count in buckets.items()}
+            inc['count'] = sum(buckets.values())
+            requests.append(UpdateOne({'station': station}, {'$inc': inc}, upsert=True))
+        if requests:
+            self.db.bulk_write(requests, ordered=False)
+
+    def rebuild(self, flats: Iterable[dict]):
+        # Replaces all sketches with ones built from flats, so old prices
+        # stop weighing on the distributions
+        sketches = defaultdict(lambda: {'count': 0, 'buckets': defaultdict(int)})
+        for flat in flats:
+            station = get_station(flat)
+            if station is None or not flat.get('price_rub'):
+                continue
+            sketch = sketches[station]
+            sketch['count'] += 1
+            sketch['buckets'][str(get_bucket(flat['price_rub']))] += 1
+        requests = [ReplaceOne({'station': station},
+                               {'station': station, 'count': sketch['count'], 'buckets': dict(sketch['buckets'])},
+                               upsert=True)
+                    for station, sketch in sketches.items()]
+        if requests:
+            self.db.bulk_write(requests, ordered=False)
+        self.db.delete_many({'station': {'$nin': list(sketches.keys())}})
+        logger.info("Rebuilt price sketches of {} stations".format(len(sketches)))
+
+    def get_stats(self) -> dict:
+        return {'classified': self.classified, 'suspicious': self.suspicious}
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Prices of offers in rubles, parsed from the display strings
+# (offer['price'][0], e.g. '45 000 руб./мес.') unless price_rub is stored
+import string
+from typing import List, Optional
+
+
+def parse_price_rub(price: Optional[List[str]]) -> Optional[int]:
+    # None for dollars, euros and no price
+    price = price or ['']
+    if '$' in price[0] or '€' in price[0]:
+        return None
+    digits = "".join(c for c in price[0] if c in string.digits)
+    return int(digits) if digits else None
+
+
+def get_price_rub(flat: dict) -> Optional[int]:
+    # Flats stored before normalize_offer have no price_rub
+    if flat.get('price_rub') is not None:
+        return flat['price_rub']
+    return parse_price_rub(flat.get('price'))
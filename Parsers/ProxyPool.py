@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from typing import List, Optional
+
+import config
+
+logger = logging.getLogger("ProxyPool")
+
+
+class ProxyStats:
+    def __init__(self, proxy: Optional[str]):
+        self.proxy = proxy
+        self.successes = 0
+        self.failures = 0
+        self.captchas = 0
+        self.consecutive_failures = 0
+        self.circuit_opens = 0
+        self.latency = None
+        self.open_until = 0.0
+
+    @property
+    def success_rate(self) -> float:
+        # Laplace smoothing, so fresh proxies are neither best nor worst
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    @property
+    def score(self) -> float:
+        latency = self.latency if self.latency is not None else config.cian_proxy_default_latency
+        return self.success_rate / max(latency, 0.01)
+
+    def is_available(self, now: float) -> bool:
+        return self.open_until <= now
+
+    def to_dict(self) -> dict:
+        return {
+            'successes': self.successes,
+            'failures': self.failures,
+            'captchas': self.captchas,
+            'latency': self.latency,
+            'open': self.open_until > time.monotonic(),
+        }
+
+
+class ProxyPool:
+    # Key None is the direct route, the rest are entries of config.proxies_list
+    def __init__(self, proxies: List[str], use_direct: bool = True):
+        self.lock = threading.Lock()
+        routes = ([None] if use_direct else []) + list(proxies)
+        self.stats = {proxy: ProxyStats(proxy) for proxy in routes}
+
+    def get_candidates(self) -> List[Optional[str]]:
+        # Healthy routes, best first. Ties keep the config order, so the
+        # direct route is tried first until there is some history.
+        now = time.monotonic()
+        with self.lock:
+            available = [stats for stats in self.stats.values() if stats.is_available(now)]
+            available.sort(key=lambda stats: stats.score, reverse=True)
+            return [stats.proxy for stats in available]
+
+    def time_until_available(self) -> float:
+        now = time.monotonic()
+        with self.lock:
+            if not self.stats:
+                return 0
+            return max(0.0, min(stats.open_until for stats in self.stats.values()) - now)
+
+    def report_success(self, proxy: Optional[str], latency: float):
+        with self.lock:
+            stats = self.stats.get(proxy)
+            if stats is None:
+                return
+            stats.successes += 1
+            stats.consecutive_failures = 0
+            stats.circuit_opens = 0
+            if stats.latency is None:
+                stats.latency = latency
+            else:
+                alpha = config.cian_proxy_latency_alpha
+                stats.latency = alpha * latency + (1 - alpha) * stats.latency
+
+    def report_failure(self, proxy: Optional[str], captcha: bool = False):
+        with self.lock:
+            stats = self.stats.get(proxy)
+            if stats is None:
+                return
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            now = time.monotonic()
+            if captcha:
+                stats.captchas += 1
+                stats.open_until = max(stats.open_until, now + config.cian_proxy_captcha_cooldown)
+            if stats.consecutive_failures >= config.cian_proxy_failures_before_open:
+                # After a cool-down the route gets one probe: another failure
+                # opens the circuit again for twice as long
+                cooldown = min(config.cian_proxy_cooldown * 2 ** stats.circuit_opens,
+                               config.cian_proxy_max_cooldown)
+                stats.circuit_opens += 1
+                stats.open_until = max(stats.open_until, now + cooldown)
+                logger.info("Circuit opened for {} for {} seconds".format(proxy or "direct route", cooldown))
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {proxy or 'direct': stats.to_dict() for proxy, stats in self.stats.items()}
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import config
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+logger = logging.getLogger("SessionPool")
+
+
+class SessionPool:
+    # One keep-alive session per route: key None is the direct route,
+    # any other key is a proxy string from config.proxies_list.
+    # Entry: <KEY>: (<requests.Session>, <last used timestamp>)
+    sessions: OrderedDict = OrderedDict()
+    lock = threading.Lock()
+    hits = 0
+    misses = 0
+    evictions = 0
+    closed_handshakes = 0
+
+    @staticmethod
+    def create_session(proxy: Optional[str]) -> requests.Session:
+        from Parsers.CianParser import parse_proxies
+        session = requests.Session()
+        # session.cookies.update({"anti_bot": "xxxx"})
+        if proxy:
+            session.proxies = parse_proxies(proxy)
+        retry = Retry(connect=3, backoff_factor=0.5)
+        adapter = HTTPAdapter(max_retries=retry,
+                              pool_connections=config.cian_session_pool_connections,
+                              pool_maxsize=config.cian_session_pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @staticmethod
+    def get_session(proxy: Optional[str] = None) -> requests.Session:
+        now = time.monotonic()
+        with SessionPool.lock:
+            SessionPool.evict_idle(now)
+            if proxy in SessionPool.sessions:
+                session, _ = SessionPool.sessions.pop(proxy)
+                SessionPool.hits += 1
+            else:
+                session = SessionPool.create_session(proxy)
+                SessionPool.misses += 1
+                while len(SessionPool.sessions) >= config.cian_session_pool_size:
+                    _, (old_session, _) = SessionPool.sessions.popitem(last=False)
+                    SessionPool.close_session(old_session)
+            SessionPool.sessions[proxy] = (session, now)
+            return session
+
+    @staticmethod
+    def evict_idle(now: float):
+        # Must be called with SessionPool.lock held
+        idle = [key for key, (_, last_used) in SessionPool.sessions.items()
+                if now - last_used > config.cian_session_idle_timeout]
+        for key in idle:
+            session, _ = SessionPool.sessions.pop(key)
+            SessionPool.close_session(session)
+
+    @staticmethod
+    def close_session(session: requests.Session):
+        SessionPool.closed_handshakes += SessionPool.count_handshakes(session)
+        SessionPool.evictions += 1
+        session.close()
+
+    @staticmethod
+    def count_handshakes(session: requests.Session) -> int:
+        # Every new urllib3 connection means a new TCP (+ TLS, + SOCKS) handshake
+        count = 0
+        for adapter in set(session.adapters.values()):
+            managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+            for manager in managers:
+                if manager is None:
+                    continue
+                for key in list(manager.pools.keys()):
+                    pool = manager.pools.get(key)
+                    if pool is not None:
+                        count += pool.num_connections
+        return count
+
+    @staticmethod
+    def get_stats() -> dict:
+        with SessionPool.lock:
+            handshakes = SessionPool.closed_handshakes + sum(
+                SessionPool.count_handshakes(session) for session, _ in SessionPool.sessions.values()
+            )
+            return {
+                'sessions': len(SessionPool.sessions),
+                'hits': SessionPool.hits,
+                'misses': SessionPool.misses,
+                'evictions': SessionPool.evictions,
+                'handshakes': handshakes,
+            }
+
+    @staticmethod
+    def close_all():
+        with SessionPool.lock:
+            while SessionPool.sessions:
+                _, (session, _) = SessionPool.sessions.popitem()
+                SessionPool.close_session(session)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import config
+
+
+class UrlCheckCache:
+    # Results of check_url_correct by canonical URL
+    # Entry: <CANONICAL URL>: (<result>, <expiration monotonic time>)
+    entries: OrderedDict = OrderedDict()
+    lock = threading.Lock()
+    hits = 0
+    misses = 0
+
+    @staticmethod
+    def get(key: str) -> Optional[bool]:
+        now = time.monotonic()
+        with UrlCheckCache.lock:
+            entry = UrlCheckCache.entries.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del UrlCheckCache.entries[key]
+                UrlCheckCache.misses += 1
+                return None
+            UrlCheckCache.entries.move_to_end(key)
+            UrlCheckCache.hits += 1
+            return entry[0]
+
+    @staticmethod
+    def put(key: str, result: bool):
+        # Negative results live shorter: a search may get offers soon
+        ttl = config.url_check_cache_ttl if result else config.url_check_negative_ttl
+        with UrlCheckCache.lock:
+            UrlCheckCache.entries[key] = (result, time.monotonic() + ttl)
+            UrlCheckCache.entries.move_to_end(key)
+            while len(UrlCheckCache.entries) > config.url_check_cache_size:
+                UrlCheckCache.entries.popitem(last=False)
+
+    @staticmethod
+    def get_stats() -> dict:
+        with UrlCheckCache.lock:
+            return {'entries': len(UrlCheckCache.entries),
+                    'hits': UrlCheckCache.hits,
+                    'misses': UrlCheckCache.misses}
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import time
 from typing import TypedDict, Callable, Optional
 
 from pika import spec
@@ -29,7 +30,10 @@ class ConsumerFactory:
         def write_msg(msg_id: dict, request: dict):
             message = {
                 'id': msg_id,
-                'req': request
+                'req': request,
+                'ts': time.time(),
+                # Consumers with their own answers queue get their answers there
+                'reply_to': answer_queue_name,
             }
             packed: bytes = dump_object(message)
             QueueWrapper.send_message(request_queue_name, packed)
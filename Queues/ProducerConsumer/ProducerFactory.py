@@ -1,34 +1,77 @@
 # -*- coding: utf-8 -*-
-from typing import TypedDict, Callable
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import Executor
+from typing import TypedDict, Callable, Optional
 
 from pika import spec
 from pika.adapters.blocking_connection import BlockingChannel
 
 from Queues import QueueWrapper, dump_object, load_object
 
+logger = logging.getLogger("ProducerFactory")
+
 
 class ReqBody(TypedDict):
     id: int
     req: dict
+    ts: Optional[float]
+    reply_to: Optional[str]
 
 
 class ProducerFactory:
+    # Time requests waited before being handled, per request queue:
+    # {<QUEUE>: {'count', 'total', 'max', 'over_target'}}
+    wait_stats = {}
+    wait_stats_lock = threading.Lock()
+
+    @staticmethod
+    def record_wait(queue_name: str, body: ReqBody, latency_target: Optional[float]):
+        if body.get('ts') is None:
+            return
+        wait = max(0.0, time.time() - body['ts'])
+        with ProducerFactory.wait_stats_lock:
+            stats = ProducerFactory.wait_stats.setdefault(queue_name,
+                                                          {'count': 0, 'total': 0.0, 'max': 0.0, 'over_target': 0})
+            stats['count'] += 1
+            stats['total'] += wait
+            stats['max'] = max(stats['max'], wait)
+            over_target = latency_target is not None and wait > latency_target
+            if over_target:
+                stats['over_target'] += 1
+        if over_target:
+            logger.warning("Request from {} waited {:.1f} seconds (target {} seconds)".format(
+                queue_name, wait, latency_target))
+        else:
+            logger.debug("Request from {} waited {:.1f} seconds".format(queue_name, wait))
+
+    @staticmethod
+    def get_wait_stats() -> dict:
+        with ProducerFactory.wait_stats_lock:
+            return {queue: dict(stats, avg=stats['total'] / stats['count'])
+                    for queue, stats in ProducerFactory.wait_stats.items()}
+
     @staticmethod
     def subscribe_producer(
             request_queue_name: str,
             answer_queue_name: str,
-            request_callback: Callable[[dict, Callable[[any], None]], bool]
+            request_callback: Callable[[dict, Callable[[any], None]], bool],
+            executor: Optional[Executor] = None,
+            prefetch_count: Optional[int] = None,
+            latency_target: Optional[float] = None,
     ):
-        def answer_callback(msg_id: int, answer) -> None:
+        # With an executor requests are handled in its workers while the
+        # consuming thread keeps serving deliveries and heartbeats
+        def answer_callback(body: ReqBody, answer) -> None:
             total_answer = {
-                'id': msg_id,
+                'id': body['id'],
                 'ans': answer,
             }
-            QueueWrapper.send_message(answer_queue_name, dump_object(total_answer))
+            QueueWrapper.send_message(body.get('reply_to') or answer_queue_name, dump_object(total_answer))
 
-        def req_callback(ch: BlockingChannel, method: spec.Basic.Deliver, _: spec.BasicProperties, body: bytes):
-            body: ReqBody = load_object(body)
-            ack = request_callback(body['req'], lambda answer: answer_callback(body['id'], answer))
+        def finish(ch: BlockingChannel, method: spec.Basic.Deliver, ack) -> None:
             if ack is None:
                 ack = True
             if ack:
@@ -36,8 +79,28 @@ class ProducerFactory:
             else:
                 ch.basic_nack(delivery_tag=method.delivery_tag)
 
-        QueueWrapper.subscribe_to_queue(callback=req_callback,
-                                        queue=request_queue_name,
-                                        auto_ack=False)
+        def process(ch: BlockingChannel, method: spec.Basic.Deliver, body: ReqBody) -> None:
+            ProducerFactory.record_wait(request_queue_name, body, latency_target)
+            try:
+                ack = request_callback(body['req'], lambda answer: answer_callback(body, answer))
+            except Exception as e:
+                logger.error("Request from {} failed: {}".format(request_queue_name, e), exc_info=True)
+                # Give a failed request one more chance, but don't loop on it
+                QueueWrapper.add_callback_threadsafe(functools.partial(
+                    ch.basic_nack, delivery_tag=method.delivery_tag, requeue=not method.redelivered))
+                return
+            QueueWrapper.add_callback_threadsafe(functools.partial(finish, ch, method, ack))
 
+        def req_callback(ch: BlockingChannel, method: spec.Basic.Deliver, _: spec.BasicProperties, body: bytes):
+            body: ReqBody = load_object(body)
+            if executor is not None:
+                executor.submit(process, ch, method, body)
+                return
+            ProducerFactory.record_wait(request_queue_name, body, latency_target)
+            ack = request_callback(body['req'], lambda answer: answer_callback(body, answer))
+            finish(ch, method, ack)
 
+        QueueWrapper.subscribe_to_queue(callback=req_callback,
+                                        queue=request_queue_name,
+                                        auto_ack=False,
+                                        prefetch_count=prefetch_count)
@@ -42,21 +42,31 @@ class QueueWrapper:
                 QueueWrapper.existing_queues.add(name)
 
     @staticmethod
-    def subscribe_to_queue(callback, queue, auto_ack=True):
+    def subscribe_to_queue(callback, queue, auto_ack=True, prefetch_count=None):
         QueueWrapper.declare_queue(queue)
+        if prefetch_count is not None:
+            # Not global, so it applies to the consumer created below only
+            QueueWrapper.channel.basic_qos(prefetch_count=prefetch_count)
         QueueWrapper.channel.basic_consume(queue,
                                            callback,
                                            auto_ack=auto_ack)
 
     @staticmethod
     def send_message(queue: str, message: bytes):
+        # May be called from worker threads, so the channel is kept local
         connection = pika.BlockingConnection(QueueWrapper.params)
-        QueueWrapper.publish_channel = connection.channel()
-        QueueWrapper.publish_channel.queue_declare(queue=queue)
+        channel = connection.channel()
+        QueueWrapper.publish_channel = channel
+        channel.queue_declare(queue=queue)
         logger.info(f"basic_publish: {queue}. {message}")
-        QueueWrapper.publish_channel.basic_publish(exchange='',
-                                                   routing_key=queue,
-                                                   body=message)
+        channel.basic_publish(exchange='',
+                              routing_key=queue,
+                              body=message)
+
+    @staticmethod
+    def add_callback_threadsafe(callback):
+        # The only safe way for other threads to act on the consuming connection
+        QueueWrapper.connection.add_callback_threadsafe(callback)
 
     @staticmethod
     def clear_queue(queue, is_publish=False):
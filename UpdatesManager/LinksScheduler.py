@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import heapq
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+import config
+from Databases.UserLinks import LinksDBManager
+
+logger = logging.getLogger("LinksScheduler")
+
+
+class LinksScheduler:
+    # In-memory copy of the links schedule. The heap may hold stale entries
+    # (rescheduled or removed links): an entry is valid only while it
+    # matches next_updates, others are skipped when they reach the top.
+    # Heap entry: (<next_update>, <link _id>)
+    heap: List[Tuple[datetime, object]] = []
+    next_updates: Dict[object, datetime] = {}
+    # <USER ID>: <set of link _ids>
+    user_links: Dict[int, Set[object]] = {}
+    last_resync = 0.0
+    lock = threading.RLock()
+
+    @staticmethod
+    def get_owner() -> str:
+        # Lease owner, also names this instance's answers queue. Set per replica
+        # by UPDATES_INSTANCE_ID, config.py is shared by all of them.
+        return os.environ.get('UPDATES_INSTANCE_ID') or config.updates_instance_id or socket.gethostname()
+
+    @staticmethod
+    def add(unique_id, user_id: int, next_update: datetime):
+        # Must be called with lock held
+        LinksScheduler.next_updates[unique_id] = next_update
+        LinksScheduler.user_links.setdefault(user_id, set()).add(unique_id)
+        heapq.heappush(LinksScheduler.heap, (next_update, unique_id))
+
+    @staticmethod
+    def resync():
+        # Reloads the whole schedule, picks up links added or changed by the bot
+        schedule = list(LinksDBManager.get_schedule())
+        with LinksScheduler.lock:
+            LinksScheduler.heap = [(link['next_update'], link['_id']) for link in schedule]
+            heapq.heapify(LinksScheduler.heap)
+            LinksScheduler.next_updates = {link['_id']: link['next_update'] for link in schedule}
+            LinksScheduler.user_links = {}
+            for link in schedule:
+                LinksScheduler.user_links.setdefault(link['id'], set()).add(link['_id'])
+            LinksScheduler.last_resync = time.monotonic()
+        logger.debug("Loaded schedule of {} links".format(len(schedule)))
+
+    @staticmethod
+    def resync_user(user_id: int):
+        # Replaces the schedule of one user's links, old heap entries go stale
+        schedule = list(LinksDBManager.get_schedule(user_id))
+        with LinksScheduler.lock:
+            for unique_id in LinksScheduler.user_links.pop(user_id, ()):
+                LinksScheduler.next_updates.pop(unique_id, None)
+            for link in schedule:
+                LinksScheduler.add(link['_id'], link['id'], link['next_update'])
+        logger.debug("Reloaded schedule of {} links of user {}".format(len(schedule), user_id))
+
+    @staticmethod
+    def resync_if_needed():
+        if time.monotonic() - LinksScheduler.last_resync >= config.updates_resync_interval:
+            LinksScheduler.resync()
+
+    @staticmethod
+    def pop_due_ids(now: datetime) -> List[object]:
+        due = []
+        with LinksScheduler.lock:
+            heap = LinksScheduler.heap
+            while heap and heap[0][0] <= now:
+                next_update, unique_id = heapq.heappop(heap)
+                if LinksScheduler.next_updates.get(unique_id) == next_update:
+                    due.append(unique_id)
+        # A link reloaded with the same next_update has two valid entries
+        return list(dict.fromkeys(due))
+
+    @staticmethod
+    def pop_due_links() -> Tuple[Optional[str], List[dict]]:
+        # Due links are leased with one update_many. The lease is held until
+        # release_links, called once the crawls are sent: links leased by
+        # another instance come back when their lease runs out, so the links
+        # of an instance dying before sending them are taken over.
+        now = datetime.utcnow()
+        due_ids = LinksScheduler.pop_due_ids(now)
+        if not due_ids:
+            return None, []
+        token, links = LinksDBManager.claim_links(due_ids, LinksScheduler.get_owner(), now,
+                                                  config.updates_lease_time)
+        claimed = set()
+        with LinksScheduler.lock:
+            for link in links:
+                claimed.add(link['_id'])
+                link['last_update'] = now
+                link['next_update'] = now + timedelta(minutes=link['frequency'])
+                LinksScheduler.add(link['_id'], link['id'], link['next_update'])
+        others = [unique_id for unique_id in due_ids if unique_id not in claimed]
+        if others:
+            LinksScheduler.reload_links(others, now)
+            logger.debug("{} due links are held by other instances or postponed".format(len(others)))
+        return token, links
+
+    @staticmethod
+    def release_links(token: str, links: List[dict]):
+        # Reschedules the sent links in the database with one bulk_write
+        LinksDBManager.reschedule(links, token)
+
+    @staticmethod
+    def reload_links(unique_ids: List[object], now: datetime):
+        # Links that were not claimed: postponed in the database, dispatched
+        # by another instance, leased by it or removed by their user
+        found = set()
+        links = LinksDBManager.get_links(unique_ids, {'_id': 1, 'id': 1, 'next_update': 1, 'lease_until': 1})
+        with LinksScheduler.lock:
+            for link in links:
+                found.add(link['_id'])
+                next_update = link['next_update']
+                if link.get('lease_until') is not None and link['lease_until'] > now:
+                    next_update = max(next_update, link['lease_until'])
+                LinksScheduler.add(link['_id'], link['id'], next_update)
+            for unique_id in unique_ids:
+                if unique_id not in found:
+                    LinksScheduler.next_updates.pop(unique_id, None)
+
+    @staticmethod
+    def get_left_time() -> float:
+        # Seconds before the next due link, not longer than the next resync
+        with LinksScheduler.lock:
+            heap = LinksScheduler.heap
+            while heap and LinksScheduler.next_updates.get(heap[0][1]) != heap[0][0]:
+                heapq.heappop(heap)
+            left = config.updates_resync_interval - (time.monotonic() - LinksScheduler.last_resync)
+            if heap:
+                left = min(left, (heap[0][0] - datetime.utcnow()).total_seconds())
+        return max(left, 0)
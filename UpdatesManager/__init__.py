@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 import threading
 import logging
+import uuid
 
 import time
 from typing import List, Callable, Dict
 
 import config
-from Databases.UserLinks import LinksDBManager
+from Parsers.CianParser import canonicalize_url
+from UpdatesManager.LinksScheduler import LinksScheduler
 from Queues.ProducerConsumer.ConsumerFactory import ConsumerFactory
 from Queues.StraightQueue import StraightQueue
 
@@ -17,36 +19,125 @@ logger.setLevel(logging.DEBUG)
 class UpdatesManager:
     link_update_request_function: Callable[[dict, any], None] = None
     links_send_function: Callable[[dict], None] = None
+    # Crawls sent to the parser and not answered yet. Users whose links
+    # are equivalent to an in-flight crawl join it instead of sending another one.
+    # Entry: <CRAWL ID>: {'key': <CANONICAL URL>, 'uids': <set>, 'time': <int>, 'sent': <timestamp>}
+    in_flight_crawls: Dict[str, dict] = {}
+    # <CANONICAL URL>: <CRAWL ID> of the latest crawl of that search
+    in_flight_keys: Dict[str, str] = {}
+    in_flight_lock = threading.Lock()
+    # Set when a user's links change, so the worker doesn't sleep past their new schedule
+    wakeup = threading.Event()
 
     @staticmethod
     def link_updated_result(info: dict, new_links: List[int]) -> None:
-        message = {
-            'uid': info['uid'],
-            'offers': new_links,
-        }
-        UpdatesManager.links_send_function(message)
+        if 'crawl' in info:
+            uids = set(info['uids'])
+            with UpdatesManager.in_flight_lock:
+                crawl = UpdatesManager.in_flight_crawls.pop(info['crawl'], None)
+                if crawl is not None:
+                    uids |= crawl['uids']
+                    if UpdatesManager.in_flight_keys.get(crawl['key']) == info['crawl']:
+                        del UpdatesManager.in_flight_keys[crawl['key']]
+        else:
+            uids = {info['uid']}
+        for uid in uids:
+            message = {
+                'uid': uid,
+                'offers': new_links,
+            }
+            UpdatesManager.links_send_function(message)
+
+    @staticmethod
+    def drop_lost_crawls():
+        # Crawls the parser didn't answer in updates_crawl_timeout are lost,
+        # nobody joins them and their entries don't stay forever
+        deadline = time.time() - config.updates_crawl_timeout
+        with UpdatesManager.in_flight_lock:
+            lost = [crawl_id for crawl_id, crawl in UpdatesManager.in_flight_crawls.items()
+                    if crawl['sent'] < deadline]
+            for crawl_id in lost:
+                crawl = UpdatesManager.in_flight_crawls.pop(crawl_id)
+                if UpdatesManager.in_flight_keys.get(crawl['key']) == crawl_id:
+                    del UpdatesManager.in_flight_keys[crawl['key']]
+        if lost:
+            logger.warning("{} crawls weren't answered in {} seconds".format(len(lost),
+                                                                             config.updates_crawl_timeout))
+
+    @staticmethod
+    def join_in_flight_crawl(key: str, uid: int, timeout: int) -> bool:
+        # Must be called with in_flight_lock held, after drop_lost_crawls
+        crawl_id = UpdatesManager.in_flight_keys.get(key)
+        if crawl_id is None:
+            return False
+        crawl = UpdatesManager.in_flight_crawls[crawl_id]
+        if crawl['time'] < timeout:
+            return False
+        crawl['uids'].add(uid)
+        return True
+
+    @staticmethod
+    def dispatch_expired_links():
+        UpdatesManager.drop_lost_crawls()
+        crawls = {}
+        token, links = LinksScheduler.pop_due_links()
+        for link in links:
+            logger.debug("Parsing offers for user " + str(link['id']))
+            timeout = max(config.cian_min_timeout, link['frequency'] * 60)
+            key = canonicalize_url(link['url'])
+            with UpdatesManager.in_flight_lock:
+                if UpdatesManager.join_in_flight_crawl(key, link['id'], timeout):
+                    logger.debug("User {} joined an in-flight crawl".format(link['id']))
+                    continue
+            crawl = crawls.setdefault(key, {'url': link['url'], 'uids': set(), 'time': timeout})
+            crawl['uids'].add(link['id'])
+            crawl['time'] = max(crawl['time'], timeout)
+
+        for key, crawl in crawls.items():
+            crawl_id = uuid.uuid4().hex
+            with UpdatesManager.in_flight_lock:
+                UpdatesManager.in_flight_crawls[crawl_id] = {'key': key, 'uids': crawl['uids'],
+                                                             'time': crawl['time'], 'sent': time.time()}
+                UpdatesManager.in_flight_keys[key] = crawl_id
+                uids = list(crawl['uids'])
+            logger.debug("Crawling {} for {} users".format(key, len(uids)))
+            UpdatesManager.link_update_request_function({'crawl': crawl_id, 'uids': uids},
+                                                        {'url': crawl['url'], 'time': crawl['time']})
+        # Only now the crawls are sent, until then the lease lets another instance take the links over
+        if links:
+            LinksScheduler.release_links(token, links)
 
     @staticmethod
     def worker():
+        LinksScheduler.resync()
         while True:
-            left_time = LinksDBManager.get_left_time_before_new_link_arrival()
+            LinksScheduler.resync_if_needed()
+            # Cleared before the schedule is read, so no change is missed
+            UpdatesManager.wakeup.clear()
+            left_time = LinksScheduler.get_left_time()
             if left_time > 0:
-                logger.debug("Waiting {} seconds for new links to come".format(left_time))
-                time.sleep(left_time)
+                logger.debug("Waiting {:.1f} seconds for new links to come".format(left_time))
+                if UpdatesManager.wakeup.wait(left_time):
+                    logger.debug("Woken up by changed links")
 
-            for link in LinksDBManager.get_expired_links():
-                logger.debug("Parsing offers for user " + str(link['id']))
-                timeout = max(config.cian_min_timeout, link['frequency'] * 60)
-                UpdatesManager.link_update_request_function({'uid': link['id']},
-                                                            {'url': link['url'], 'time': timeout})
+            UpdatesManager.dispatch_expired_links()
+
+    @staticmethod
+    def links_changed(message: dict) -> bool:
+        LinksScheduler.resync_user(message['uid'])
+        UpdatesManager.wakeup.set()
+        return True
 
     @staticmethod
     def init_manager():
         logger.info("Initializing updates manager")
 
+        # Every instance gets its own answers queue: users joining an in-flight
+        # crawl are known to the instance that sent it only
         UpdatesManager.link_update_request_function = ConsumerFactory.get_consumer(
             config.parse_url_req_queue,
-            config.parse_url_ans_queue,
+            "{}.{}".format(config.parse_url_ans_queue, LinksScheduler.get_owner()),
             UpdatesManager.link_updated_result)
 
         UpdatesManager.links_send_function = StraightQueue.get_sender(config.new_offers_queue)
+        StraightQueue.subscribe_getter(config.links_changes_queue, UpdatesManager.links_changed)
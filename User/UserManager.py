@@ -14,6 +14,7 @@ logger = logging.getLogger("UserManager")
 
 class UserManager:
     link_check_request_function: Callable[[dict, dict], None] = None
+    links_changes_send_function: Callable[[dict], None] = None
     users_dict = {}
     dict_lock = threading.Lock()
     bot: Telegram = None
@@ -50,6 +51,13 @@ class UserManager:
             UserManager.link_check_acquired)
 
         StraightQueue.subscribe_getter(config.new_offers_queue, UserManager.new_offers_callback)
+        UserManager.links_changes_send_function = StraightQueue.get_sender(config.links_changes_queue)
+
+    @staticmethod
+    def links_changed(user_id):
+        # The updates manager reloads the user's links schedule at once
+        logger.debug("Links of user {} changed".format(user_id))
+        UserManager.links_changes_send_function({'uid': user_id})
 
     @staticmethod
     def delete_user(user_id):
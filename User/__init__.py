@@ -63,6 +63,7 @@ class User:
     def delete_user(self):
         logger.debug("Deleting user {}".format(self.user_id))
         LinksDBManager.remove_all_links(self.user_id)
+        self.notify_links_changed()
         User.db.remove(self.db_filter)
         self.delete_callback()
 
@@ -129,13 +130,24 @@ class User:
         logger.debug("Sending new offers to user " + str(self.user_id))
         logger.debug(f'updated_ids: {updates_ids}')
         updates = FlatsDB.get_flats(updates_ids)
-        received_links = set(User.db.find_one(self.db_filter)['received_links'])
+        data = User.db.find_one(self.db_filter, {'received_links': 1, 'received_clusters': 1})
+        received_links = set(data['received_links'])
+        # Reposts of an already sent flat by other agents share its duplicate cluster
+        received_clusters = set(data.get('received_clusters', []))
         logger.debug(f'received_links: {received_links}')
         new_links = set()
-        required_updates = (x for x in updates if x['id'] not in received_links)
+        new_clusters = set()
+        # Results of user links aren't filtered before, scam-priced offers are dropped here
+        required_updates = (x for x in updates if x['id'] not in received_links and not x.get('suspicious'))
         message = ""
         for update in required_updates:
             logger.debug(f'update: {update}')
+            cluster = update.get('duplicate_cluster')
+            if cluster is not None:
+                if cluster in received_clusters or cluster in new_clusters:
+                    logger.debug("Offer {} is a duplicate of cluster {}".format(update['id'], cluster))
+                    continue
+                new_clusters.add(cluster)
             new_links.add(update['id'])
             if 'metro' in update['location']:
                 metro = update['location']['metro']
@@ -147,9 +159,13 @@ class User:
                                                                    info_cmd=bot_strings.cian_base_cmd.format(
                                                                        id=update['id']),
                                                                    url=update['url']) + '\n'
-        self.callback(message, parse_mode='Markdown', disable_web_page_preview=True)
+        if message:
+            self.callback(message, parse_mode='Markdown', disable_web_page_preview=True)
         if len(new_links) > 0:
-            User.db.update_one(self.db_filter, {'$push': {'received_links': {'$each': list(new_links)}}})
+            update = {'$push': {'received_links': {'$each': list(new_links)}}}
+            if new_clusters:
+                update['$addToSet'] = {'received_clusters': {'$each': list(new_clusters)}}
+            User.db.update_one(self.db_filter, update)
 
     def pull_auth_message(self, message):
         self.messages_before_ignore_left -= 1
@@ -178,6 +194,7 @@ class User:
 
         for link in LinksDBManager.get_user_links(self.user_id):
             LinksDBManager.update_frequency(link['_id'], value)
+        self.notify_links_changed()
 
     @property
     def authorized(self):
@@ -230,11 +247,17 @@ class User:
                      " with tag " + tag)
         self._links.append(LinksDBManager.add_user_link(self.user_id, link, tag,
                                                         self.updates_duration, 'CIAN'))
+        self.notify_links_changed()
 
     def remove_links(self):
         logger.debug("User {} removing all links".format(self.user_id))
         self._links = []
         LinksDBManager.remove_all_links(self.user_id)
+        self.notify_links_changed()
+
+    def notify_links_changed(self):
+        from User.UserManager import UserManager
+        UserManager.links_changed(self.user_id)
 
     def set_menu(self, message_text, inline_keyboard, parse_mode=None, invoke=False):
         inline_keyboard = TelegramAPI.MessageFunctionObject.get_inline_keyboard(inline_keyboard)